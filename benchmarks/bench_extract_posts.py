@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Time taken to find the posts on an index page
+
+Compares Konadl.extract_posts, which uses compiled regular
+expressions, with the BeautifulSoup extraction it replaced,
+on a generated page laid out like a moebooru post list.
+
+Usage: python benchmarks/bench_extract_posts.py [posts per page] [rounds]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from libkonadl import Konadl, Post, make_soup  # noqa: E402
+
+RATINGS = ('Safe', 'Questionable', 'Explicit')
+
+
+def make_page(posts):
+    items = []
+    for post_id in range(posts, 0, -1):
+        items.append(
+            '<li style="width: 160px;" id="p{0}" class="creator-id-1"><div class="inner">'
+            '<a class="thumb" href="/post/show/{0}"><img src="https://konachan.com/data/preview/{0}.jpg" '
+            'alt="Rating: {1} Score: 12 Tags: long_hair original User: someone" class="preview" width="150"></a>'
+            '</div><a class="directlink largeimg" href="//konachan.com/image/{2:032x}/Konachan.com%20-%20{0}%20tag.jpg">'
+            '<span class="directlink-info">1920x1080</span></a></li>'.format(post_id, RATINGS[post_id % 3], post_id))
+    return ('<html><head><title>Konachan</title></head><body><div id="paginator"></div>'
+            '<ul id="post-list-posts">{}</ul></body></html>').format(''.join(items))
+
+
+def extract_posts_soup(kona, page_source, page):
+    # Extraction as it was done before extract_posts used regular expressions
+    soup = make_soup(page_source)
+    posts_list = soup.find('ul', {'id': 'post-list-posts'})
+    page_posts = []
+    for post in posts_list.find_all('li'):
+        alt = post.find('img', alt=True)['alt']
+        rating = False
+        if 'Rating: Safe' in alt and kona.safe:
+            rating = 'safe'
+        elif 'Rating: Questionable' in alt and kona.questionable:
+            rating = 'questionable'
+        elif 'Rating: Explicit' in alt and kona.explicit:
+            rating = 'explicit'
+        if rating:
+            url = post.find('a', {'class': 'directlink'})['href']
+            if 'https:' not in url:
+                url = '{}{}'.format('https:', url)
+            page_posts.append(Post(int(post['id'][1:]), url, page, rating))
+    return page_posts
+
+
+def measure(name, extract, kona, page_source, rounds):
+    begin_time = time.perf_counter()
+    for _ in range(rounds):
+        posts = extract(page_source, 1)
+    elapsed = (time.perf_counter() - begin_time) / rounds
+    print('{:15} {:8.3f} ms per page ({} posts)'.format(name, elapsed * 1000, len(posts)))
+    return posts
+
+
+if __name__ == '__main__':
+    posts = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    kona = Konadl()
+    kona.safe = kona.questionable = kona.explicit = True
+    page_source = make_page(posts)
+
+    found = measure('BeautifulSoup', lambda source, page: extract_posts_soup(kona, source, page), kona,
+                    page_source, rounds)
+    found_regex = measure('regex', kona.extract_posts, kona, page_source, rounds)
+    assert [(post.id, post.url, post.rating) for post in found] == \
+        [(post.id, post.url, post.rating) for post in found_regex], 'extractions differ'
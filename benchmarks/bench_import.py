@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Import time and the cost of an update with nothing new
+
+Imports libkonadl in a fresh interpreter under python -X
+importtime and reports its cumulative import time, along with
+whether the heavy dependencies have been loaded. The CLI cannot
+be imported, so the startup of konadl_cli.py --help is timed
+as a whole instead. Then times Konadl.update() against a stub
+session for a storage that is already up to date, which should
+only take the one request for the newest post.
+
+Usage: python benchmarks/bench_import.py [rounds]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+HEAVY_MODULES = ('bs4', 'requests', 'pickle')
+
+
+def startup_time(rounds):
+    # Seconds taken by the CLI to start and print its help
+    begin_time = time.perf_counter()
+    for _ in range(rounds):
+        subprocess.run([sys.executable, 'konadl_cli.py', '--help'], cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - begin_time) / rounds
+
+
+def import_time(module):
+    # Cumulative import time of module in microseconds, and
+    # which of the heavy modules got imported along with it
+    check = 'import sys, {}; print(",".join(name for name in {!r} if name in sys.modules))'.format(
+        module, HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', check], cwd=ROOT,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]), result.stdout.strip()
+    raise RuntimeError('{} not found in import times'.format(module))
+
+
+class NewestPostResponse:
+
+    def __init__(self, newest_id):
+        self.newest_id = newest_id
+
+    def json(self):
+        return [{'id': self.newest_id}]
+
+
+class StubSession:
+    # Answers the newest post request, counting requests
+
+    def __init__(self, newest_id):
+        self.newest_id = newest_id
+        self.requests = 0
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        return NewestPostResponse(self.newest_id)
+
+
+def time_update(rounds):
+    from libkonadl import Konadl
+
+    with tempfile.TemporaryDirectory() as storage:
+        storage = os.path.join(storage, '')
+        with open('{}metadata.json'.format(storage), 'w') as metadataf:
+            json.dump({'RATINGS': {'safe': True, 'questionable': False, 'explicit': False},
+                       'STATISTICS': {'total_downloads': 0, 'time_elapsed': 0},
+                       'UPDATING': {'previous_newest_id': 'p1000', 'SEPARATE': False}}, metadataf)
+
+        begin_time = time.perf_counter()
+        for _ in range(rounds):
+            kona = Konadl()
+            kona.storage = storage
+            kona.session = StubSession(1000)
+            assert kona.update() is False
+            assert kona.session.requests == 1
+        return (time.perf_counter() - begin_time) / rounds
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    microseconds, loaded = import_time('libkonadl')
+    print('import libkonadl       {:8.1f} ms  heavy modules loaded: {}'.format(microseconds / 1000, loaded or 'none'))
+    print('konadl_cli.py --help   {:8.1f} ms'.format(startup_time(max(1, rounds // 10)) * 1000))
+    print('update() up to date    {:8.3f} ms per run'.format(time_update(rounds) * 1000))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Write throughput and page cache growth of the I/O policies
+
+Writes the same set of image sized files with every
+FileSystemSink I/O policy and reports the write rate and how
+much the page cache grew, read from /proc/meminfo (Linux
+only). The directory should be on the disk the images are
+stored on; tmpfs keeps everything in memory regardless.
+
+Usage: python benchmarks/bench_io_policy.py DIRECTORY [rounds]
+"""
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from libkonadl import FileSystemSink  # noqa: E402
+
+
+def page_cache():
+    # Size of the page cache in bytes
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            if line.startswith('Cached:'):
+                return int(line.split()[1]) * 1024
+
+
+class BenchmarkSink(FileSystemSink):
+    # Files are named by number instead of by post
+
+    def path(self, post):
+        return '{}{}.jpg'.format(self.storage, post)
+
+
+def measure(directory, policy, images):
+    storage = os.path.join(directory, 'bench_{}'.format(policy), '')
+    shutil.rmtree(storage, ignore_errors=True)
+    os.makedirs(storage)
+    sink = BenchmarkSink(storage, io_policy=policy)
+
+    os.sync()
+    cached = page_cache()
+    begin_time = time.perf_counter()
+    for number, content in enumerate(images):
+        sink.write(number, content)
+    if policy == 'buffered':
+        os.sync()  # The other policies sync every file
+    elapsed = time.perf_counter() - begin_time
+    growth = page_cache() - cached
+
+    for number, content in enumerate(images):
+        with open(sink.path(number), 'rb') as image:
+            assert image.read() == content, 'image {} differs'.format(number)
+    shutil.rmtree(storage)
+
+    size = sum(len(content) for content in images)
+    print('{:9} {:8.1f} MiB/s  page cache {:+8.1f} MiB'.format(policy, size / elapsed / 1048576, growth / 1048576))
+
+
+if __name__ == '__main__':
+    directory = sys.argv[1]
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    # Typical image sizes, plus one that is a multiple of the O_DIRECT alignment
+    images = [os.urandom(size) for size in (1500123, 3000000, 700001, 4096 * 300)] * rounds
+    print('{:.0f} MiB in {} files'.format(sum(len(content) for content in images) / 1048576, len(images)))
+    for policy in FileSystemSink.IO_POLICIES:
+        measure(directory, policy, images)
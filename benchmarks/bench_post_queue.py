@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Memory use and save/load time of the download queue
+
+Compares a pickled Queue of Post objects, which is how
+download_queue was saved before PostQueue, with PostQueue
+and its binary format.
+
+Usage: python benchmarks/bench_post_queue.py [number of posts]
+"""
+import copyreg
+import io
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from libkonadl import Post, PostQueue, Queue, pickle_queue, unpickle_queue  # noqa: E402
+
+
+def make_posts(amount):
+    for number in range(amount):
+        url = 'https://konachan.com/image/{:032x}/Konachan.com%20-%20{}%20long_hair%20blue_eyes%20original.jpg'.format(
+            number * 7919, number + 1)
+        yield Post(number + 1, url, number // 21 + 1, PostQueue.RATINGS[number % 3])
+
+
+def measure(name, queue_class, amount):
+    tracemalloc.start()
+    queue = queue_class()
+    for post in make_posts(amount):
+        queue.put(post)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    saved = io.BytesIO()
+    begin_time = time.time()
+    if queue_class is PostQueue:
+        queue.save(saved)
+    else:
+        pickle.dump(queue, saved)
+    save_time = time.time() - begin_time
+
+    saved.seek(0)
+    begin_time = time.time()
+    if queue_class is PostQueue:
+        PostQueue.load(saved)
+    else:
+        pickle.load(saved)
+    load_time = time.time() - begin_time
+
+    print('{:15} {:6.0f} MB in memory {:6.0f} MB file  save {:6.2f}s  load {:6.2f}s'.format(
+        name, memory / 1048576, len(saved.getvalue()) / 1048576, save_time, load_time))
+
+
+if __name__ == '__main__':
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    copyreg.pickle(Queue, pickle_queue, unpickle_queue)
+    print('{} queued posts, python {}'.format(amount, sys.version.split()[0]))
+    measure('Queue + pickle', Queue, amount)
+    measure('PostQueue', PostQueue, amount)
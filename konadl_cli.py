@@ -10,8 +10,16 @@ Licensed under the GNU General Public License Version 3 (GNU GPL v3),
 (C) 2018 K4YT3X
 """
 from avalon_framework import Avalon
+from libkonadl import Batch
+from libkonadl import FaultyProgressFile
 from libkonadl import Konadl  # Import libkonadl
+from libkonadl import LAYOUTS
+from libkonadl import S3Sink
+from libkonadl import parse_schedule_window
+from libkonadl import parse_size
 from libkonadl import print_locker
+from libkonadl import read_history
+from libkonadl import summarize_history
 import argparse
 import os
 import time
@@ -35,6 +43,22 @@ def process_arguments():
     control_group.add_argument('-o', '--storage', help='Storage directory', action='store', default=False)
     control_group.add_argument('--separate', help='Separate images into folders by ratings', action='store_true', default=False)
     control_group.add_argument('-u', '--update', help='Update new images', action='store_true', default=False)
+    control_group.add_argument('--verify', help='Verify images in the storage directory and exit', action='store_true', default=False)
+    control_group.add_argument('--verify-images', help='Also check downloaded images for truncation', action='store_true', default=False)
+    control_group.add_argument('--retry-dead-letter', help='Only retry the jobs that have been given up on', action='store_true', default=False)
+    control_group.add_argument('--max-attempts', help='Failed attempts before a job is given up on', type=int, action='store', default=5)
+    control_group.add_argument('--retry-backoff', help='Seconds before the first retry, doubled on every failed attempt', type=float, action='store', default=1.0)
+    control_group.add_argument('--history', help='Summarize the recorded runs of the storage directory and exit', action='store_true', default=False)
+    control_group.add_argument('--batch', help='Run every target of a JSON/YAML job file without asking anything', action='store', default=False)
+    control_group.add_argument('--results', help='Write the results of --batch targets to this JSON file', action='store', default=False)
+    storage_group = parser.add_argument_group('Storage')
+    storage_group.add_argument('--variant', help='Image variant to download, "largest" picks the largest one under --max-size', choices=['original', 'jpeg', 'sample', 'preview', 'largest'], action='store', default='original')
+    storage_group.add_argument('--max-size', help='Maximum image size for --variant largest, e.g. 5M', action='store', default=None)
+    storage_group.add_argument('--layout', help='Directory layout of stored images', choices=sorted(LAYOUTS), action='store', default='flat')
+    storage_group.add_argument('--io-policy', help='How images are written: "dontneed" keeps them out of the page cache, "direct" also uses O_DIRECT', choices=['buffered', 'dontneed', 'direct'], action='store', default='buffered')
+    storage_group.add_argument('--s3-endpoint', help='Store images in an S3 compatible server at this URL', action='store', default=False)
+    storage_group.add_argument('--s3-bucket', help='S3 bucket to store images in', action='store', default=False)
+    storage_group.add_argument('--s3-region', help='S3 region', action='store', default='us-east-1')
     ratings_group = parser.add_argument_group('Ratings')
     ratings_group.add_argument('-s', '--safe', help='Include Safe rated images', action='store_true', default=False)
     ratings_group.add_argument('-q', '--questionable', help='Include Questionable rated images', action='store_true', default=False)
@@ -42,6 +66,18 @@ def process_arguments():
     threading_group = parser.add_argument_group('Threading')
     threading_group.add_argument('-c', '--crawlers', help='Number of post crawler threads', type=int, action='store', default=10)
     threading_group.add_argument('-d', '--downloaders', help='Number of downloader threads', type=int, action='store', default=20)
+    threading_group.add_argument('--verifiers', help='Number of image verifier threads', type=int, action='store', default=4)
+    bandwidth_group = parser.add_argument_group('Bandwidth')
+    bandwidth_group.add_argument('--limit-rate', help='Maximum download rate, e.g. 2M for 2 MiB/s', action='store', default='0')
+    bandwidth_group.add_argument('--host-limit', help='Maximum download rate for a host, e.g. files.yande.re=1M', action='append', default=[])
+    bandwidth_group.add_argument('--schedule', help='Download rate during a time of day, e.g. 09:00-18:00=512K', action='append', default=[])
+    diagnostics_group = parser.add_argument_group('Diagnostics')
+    diagnostics_group.add_argument('--record', help='Record HTTP traffic to this directory', action='store', default=False)
+    diagnostics_group.add_argument('--record-images', help='Also record image bodies with --record', action='store_true', default=False)
+    diagnostics_group.add_argument('--replay', help='Replay HTTP traffic recorded with --record instead of using the network', action='store', default=False)
+    diagnostics_group.add_argument('--replay-latency', help='Factor applied to recorded response times when replaying', type=float, action='store', default=1.0)
+    diagnostics_group.add_argument('--profile', help='Profile worker threads, results are written to the profiles folder of the storage', choices=['cprofile', 'sample'], action='store', default=None)
+    diagnostics_group.add_argument('--profile-interval', help='Seconds between samples with --profile sample', type=float, action='store', default=0.005)
     etc_group = parser.add_argument_group('Extra')
     etc_group.add_argument('-v', '--version', help='Show KonaDL version and exit', action='store_true', default=False)
     return parser.parse_args()
@@ -98,7 +134,7 @@ def display_options(kona, load_progress, args):
     """
     Avalon.debug_info('Program Started')
     Avalon.info('Using storage directory: {}{}'.format(Avalon.FG.W, kona.storage))
-    if load_progress or args.update:
+    if load_progress or args.update or args.retry_dead_letter:
         Avalon.info('Sourcing configuration defined in the metadata file')
     else:
         if kona.safe:
@@ -124,6 +160,29 @@ def display_options(kona, load_progress, args):
     Avalon.info('Opening {}{}{}{}{} downloader threads\n'.format(Avalon.FG.W, Avalon.FM.BD, args.downloaders, Avalon.FM.RST, Avalon.FG.G))
 
 
+def show_history(storage):
+    """ Summarizes the runs recorded in the storage
+
+    Prints the throughput of the last runs and warns
+    about runs much slower than the ones before them.
+    """
+    rows = summarize_history(read_history('{}history.jsonl'.format(storage)))
+    if not rows:
+        Avalon.warning('No runs recorded in {}'.format(storage))
+        return
+    for row in rows[-20:]:
+        Avalon.info('{} {:>6} {:>6} image(s) {:>9.2f} MiB {:>9.1f}s {:>7.2f} image(s)/s {:>8.2f} KiB/s retries={} 429={}'.format(
+            row['started'], row['status'], row['images'], row['bytes'] / 1048576, row['duration'],
+            row['images_per_second'], row['bytes_per_second'] / 1024, row['retries'], row['http_429']))
+    last = rows[-1]
+    if last['images'] and last['median_bytes_per_second']:
+        ratio = last['bytes_per_second'] / last['median_bytes_per_second']
+        if ratio < 0.8:
+            Avalon.warning('Last run was {}% slower than the median of previous runs'.format(round((1 - ratio) * 100)))
+        else:
+            Avalon.info('Last run ran at {}% of the median of previous runs'.format(round(ratio * 100)))
+
+
 class KonadlAvalon(Konadl):
     """ Overwrite original methods for better
     appearance and readability using avalon
@@ -166,16 +225,26 @@ class KonadlAvalon(Konadl):
         Avalon.warning('Trying to recover from error')
         Avalon.warning('Putting job back to queue')
 
+    @print_locker
+    def print_verification_failed(self, post):
+        Avalon.error('Verification failed: {}'.format(post.url))
+        Avalon.warning('Putting job back to queue')
+
+    @print_locker
+    def print_dead_letter(self, job):
+        Avalon.error('Giving up after {} attempt(s): {}'.format(job['attempts'], job.get('url', job['page'])))
+        Avalon.error(job['error'])
+
     @print_locker
     def print_faulty_progress_file(self):
         Avalon.error('Faulty progress file!')
         Avalon.error('Aborting\n')
 
 
-args = process_arguments()
-
 try:
     if __name__ == '__main__':
+        # Arguments are only parsed when running as a program
+        args = process_arguments()
         kona = KonadlAvalon()  # Create crawler object
         kona.icon()
 
@@ -188,11 +257,37 @@ try:
             print('Contact: k4yt3x@protonmail.com\n')
             exit(0)
 
+        if args.batch:
+            batch = Batch.load(args.batch, KonadlAvalon)
+            Avalon.info('Running {}{}{}{}{} target(s) from {}'.format(Avalon.FG.W, Avalon.FM.BD, len(batch.targets), Avalon.FM.RST, Avalon.FG.G, args.batch))
+            results = batch.run()
+            if args.results:
+                batch.save_results(args.results)
+            for result in results:
+                if result['status'] == 'failed':
+                    Avalon.error('{}: failed: {}'.format(result['name'], result['error']))
+                else:
+                    Avalon.info('{}: {}, {} image(s) downloaded in {} seconds'.format(result['name'], result['status'], result['downloads'], result['time_elapsed']))
+            exit(1 if any(result['status'] == 'failed' for result in results) else 0)
+
         kona.storage = check_storage_dir(args)
         if kona.storage is False:
             Avalon.error('Please specify storage directory\n')
             exit(1)
 
+        if args.verify:
+            kona.verifier_threads_amount = args.verifiers
+            Avalon.info('Verifying images in {}{}{}'.format(Avalon.FG.W, Avalon.FM.BD, kona.storage))
+            failed = kona.verify_storage()
+            for path in failed:
+                Avalon.error('Verification failed: {}'.format(path))
+            Avalon.info('{}{}{}{}{} image(s) failed verification\n'.format(Avalon.FG.W, Avalon.FM.BD, len(failed), Avalon.FM.RST, Avalon.FG.G))
+            exit(1 if failed else 0)
+
+        if args.history:
+            show_history(kona.storage)
+            exit(0)
+
         # If progress file exists
         # Ask user if he or she wants to load it
         load_progress = False
@@ -207,15 +302,44 @@ try:
 
         # Pass terminal arguments to libkonadl object
         kona.separate = args.separate
+        kona.layout = args.layout
+        kona.io_policy = args.io_policy
+        kona.variant = args.variant
+        if args.variant == 'largest' and not args.max_size:
+            Avalon.error('Please specify the largest image size to download with --max-size\n')
+            exit(1)
+        kona.max_image_size = parse_size(args.max_size or 0)
+        if args.s3_endpoint:
+            if not args.s3_bucket:
+                Avalon.error('Please specify the bucket to store images in with --s3-bucket\n')
+                exit(1)
+            kona.sink = S3Sink.from_environment(args.s3_endpoint, args.s3_bucket, args.s3_region,
+                                                separate=args.separate, layout=LAYOUTS[args.layout]())
         kona.yandere = args.yandere
         kona.safe = args.safe
         kona.questionable = args.questionable
         kona.explicit = args.explicit
         kona.post_crawler_threads_amount = args.crawlers
         kona.downloader_threads_amount = args.downloaders
+        kona.verifier_threads_amount = args.verifiers
+        kona.verify_images = args.verify_images
+        kona.max_attempts = args.max_attempts
+        kona.retry_backoff = args.retry_backoff
+        kona.record = args.record or None
+        kona.record_images = args.record_images
+        kona.replay = args.replay or None
+        kona.replay_latency = args.replay_latency
+        kona.profile = args.profile
+        kona.profile_interval = args.profile_interval
+        kona.bandwidth_limit = parse_size(args.limit_rate)
+        for host_limit in args.host_limit:
+            host, rate = host_limit.split('=')
+            kona.host_bandwidth_limits[host] = parse_size(rate)
+        for window in args.schedule:
+            kona.bandwidth_schedule.append(parse_schedule_window(window))
         display_options(kona, load_progress, args)
 
-        if not kona.safe and not kona.questionable and not kona.explicit and not load_progress and not args.update:
+        if not kona.safe and not kona.questionable and not kona.explicit and not load_progress and not args.update and not args.retry_dead_letter:
             Avalon.error('Please supply information about what you want to download')
             print(Avalon.FM.BD + 'You must include one of the following arguments:')
             print('  -s, --safe            Include Safe rated images')
@@ -223,7 +347,7 @@ try:
             print('  -e, --explicit        Include Explicit rated images')
             print('Use --help for more information\n' + Avalon.FM.RST)
             exit(1)
-        elif not args.pages and not args.all and not args.page and not load_progress and not args.update:
+        elif not args.pages and not args.all and not args.page and not load_progress and not args.update and not args.retry_dead_letter:
             Avalon.error('Please supply information about what you want to download')
             print(Avalon.FM.BD + 'You must include one of the following arguments:')
             print('  -n PAGES, --pages PAGES')
@@ -233,7 +357,14 @@ try:
             print('Use --help for more information\n' + Avalon.FM.RST)
 
         if load_progress:
-            kona.crawl()
+            try:
+                kona.crawl()
+            except FaultyProgressFile:
+                exit(1)
+        elif args.retry_dead_letter:
+            Avalon.info('Retrying jobs that have been given up on')
+            if kona.retry_dead_letter() is False:
+                Avalon.info('{}{}No jobs to retry\n'.format(Avalon.FM.BD, Avalon.FG.W))
         elif args.update:
             Avalon.info('Updating new images')
             if kona.update() is False:
@@ -12,7 +12,7 @@
 Name: Konachan Downloader Library
 Dev: K4YT3X
 Date Created: April 11, 2018
-Last Modified: July 7, 2018
+Last Modified: October 19, 2026
 
 Licensed under the GNU General Public License Version 3 (GNU GPL v3),
     available at: https://www.gnu.org/licenses/gpl-3.0.txt
@@ -22,23 +22,156 @@ Description: Konachan downloader is a simple python
 script / library that will help you download
 konachan.com / konachan.net images.
 """
-from bs4 import BeautifulSoup
+from abc import ABC
+from abc import abstractmethod
+from array import array
+from queue import Empty
+from queue import Full
 from queue import Queue as _Queue
 import copyreg
 import datetime
+import hashlib
+import hmac
 import json
+import mmap
 import os
-import pickle
-import requests
+import re
+import struct
 import sys
 import threading
 import time
 import traceback
+import urllib.parse
+
+
+class FaultyProgressFile(Exception):
+    """ Raised when saved progress can not be loaded
+    """
+    pass
+
+
+class QueueClosed(Exception):
+    """ Raised by a closed queue instead of waiting for jobs
+    """
+    pass
+
+
+class Cancelled(Exception):
+    """ Raised in worker threads once the crawl is cancelled
+    """
+    pass
 
 
 # Make Queue a new-style class, so it can be used with copy_reg
 class Queue(_Queue, object):
-    pass
+    """ Queue that can be closed
+
+    Once closed, get() raises QueueClosed instead of
+    waiting for more jobs, and so does put() instead of
+    waiting for room. This wakes up all worker threads
+    without having to put exit signals into the queue.
+    """
+
+    closed = False
+
+    def close(self):
+        with self.mutex:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not block:
+                if not self._qsize():
+                    if self.closed:
+                        raise QueueClosed
+                    raise Empty
+            elif timeout is None:
+                while not self._qsize():
+                    if self.closed:
+                        raise QueueClosed
+                    self.not_empty.wait()
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            else:
+                endtime = time.monotonic() + timeout
+                while not self._qsize():
+                    if self.closed:
+                        raise QueueClosed
+                    remaining = endtime - time.monotonic()
+                    if remaining <= 0.0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+            item = self._get()
+            self.not_full.notify()
+            return item
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_full:
+            if self.maxsize > 0:
+                if not block:
+                    if self._qsize() >= self.maxsize:
+                        if self.closed:
+                            raise QueueClosed
+                        raise Full
+                elif timeout is None:
+                    while self._qsize() >= self.maxsize:
+                        if self.closed:
+                            raise QueueClosed
+                        self.not_full.wait()
+                elif timeout < 0:
+                    raise ValueError("'timeout' must be a non-negative number")
+                else:
+                    endtime = time.monotonic() + timeout
+                    while self._qsize() >= self.maxsize:
+                        if self.closed:
+                            raise QueueClosed
+                        remaining = endtime - time.monotonic()
+                        if remaining <= 0.0:
+                            raise Full
+                        self.not_full.wait(remaining)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+class JobTracker:
+    """ Counts jobs that have not gone through the pipeline
+
+    A job is added when it enters the pipeline (a page to
+    crawl or a post to download) and is done once it will
+    never be put back to any queue. The drained event is
+    set whenever nothing is outstanding, or for good once
+    the tracker has been stopped.
+    """
+
+    def __init__(self):
+        self.outstanding = 0
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.drained = threading.Event()
+        self.drained.set()
+
+    def add(self, amount=1):
+        with self.lock:
+            self.outstanding += amount
+            if self.outstanding and not self.stopped:
+                self.drained.clear()
+
+    def done(self):
+        with self.lock:
+            self.outstanding -= 1
+            if not self.outstanding:
+                self.drained.set()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.drained.set()
+
+    def wait(self):
+        self.drained.wait()
 
 
 def pickle_queue(q):
@@ -49,6 +182,8 @@ def pickle_queue(q):
     del q_dct['not_empty']
     del q_dct['not_full']
     del q_dct['all_tasks_done']
+    # A restored queue starts out open
+    q_dct.pop('closed', None)
     return Queue, (), q_dct
 
 
@@ -63,6 +198,449 @@ def unpickle_queue(state):
     return q
 
 
+# Matches one post of the post list in a single pass: the id of
+# the <li>, the rating from the thumbnail's alt text and the
+# directlink <a> tag, without ever leaving the post's <li>
+POST_PATTERN = re.compile(
+    r'<li\b[^>]*?\bid="p(\d+)"'
+    r'(?:(?!</li>).)*?(<img\b[^>]*?\balt="Rating: (\w+)[^>]*>)'
+    r'(?:(?!</li>).)*?(<a\b[^>]*?\bclass="[^"]*?\bdirectlink\b[^>]*>)', re.S)
+HREF_PATTERN = re.compile(r'\bhref="([^"]+)"')
+SRC_PATTERN = re.compile(r'\bsrc="([^"]+)"')
+# Moebooru embeds the data of every listed post as JSON, either
+# one Post.register() call per post or one Post.register_resp()
+POST_DATA_PATTERN = re.compile(r'Post\.register(?:_resp)?\((\{.*\})\);?\s*$', re.M)
+RATING_NAMES = {'Safe': 'safe', 'Questionable': 'questionable', 'Explicit': 'explicit'}
+
+
+# Post id in image file names, e.g. "Konachan.com%20-%20123456%20tags.jpg"
+LEGACY_ID_PATTERN = re.compile(r'%20(\d+)%20')
+
+# Responses that will not change however often they are retried
+PERMANENT_STATUS_CODES = (400, 404, 410)
+
+# Longest wait before a failed job is retried, in seconds
+MAX_RETRY_BACKOFF = 300
+
+
+def error_status(error):
+    # HTTP status code of the response an error was raised for
+    response = getattr(error, 'response', None)
+    return None if response is None else response.status_code
+
+
+def make_soup(markup):
+    """ Parses an HTML document
+
+    BeautifulSoup is by far the slowest dependency to
+    import, so it is only loaded once a page actually
+    needs to be parsed.
+    """
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(markup, 'html.parser')
+
+
+def image_truncated(content):
+    """ Checks whether an image file has been cut short
+
+    Looks for the end of image marker of JPEG, PNG and
+    GIF files. Other formats are assumed to be complete.
+    """
+    if content[:2] == b'\xff\xd8':
+        return not content.rstrip(b'\x00').endswith(b'\xff\xd9')
+    elif content[:8] == b'\x89PNG\r\n\x1a\n':
+        return not content.endswith(b'IEND\xaeB`\x82')
+    elif content[:4] == b'GIF8':
+        return not content.endswith(b';')
+    return False
+
+
+def parse_size(size):
+    """ Converts a size such as 512K or 1.5M to bytes
+
+    Both the suffix and its case are optional. Suffixes
+    are binary, so 1K is 1024 bytes.
+    """
+    size = str(size).strip().upper().rstrip('B')
+    multiplier = 1
+    for power, suffix in enumerate('KMGT', 1):
+        if size.endswith(suffix):
+            size = size[:-1]
+            multiplier = 1024 ** power
+            break
+    return int(float(size) * multiplier)
+
+
+def parse_schedule_window(window):
+    """ Parses a bandwidth schedule window
+
+    Converts e.g. "09:00-18:00=512K" into the
+    ('09:00', '18:00', 524288) tuples used by
+    Konadl.bandwidth_schedule.
+    """
+    times, rate = window.split('=')
+    start, end = times.split('-')
+    return start.strip().zfill(5), end.strip().zfill(5), parse_size(rate)
+
+
+def make_session(headers, pool_size):
+    """ Creates a requests session
+
+    requests is imported here rather than at module
+    level to keep the library cheap to import.
+    """
+    import requests
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def request_key(url, params=None):
+    # Identifies a request in recorded traffic
+    if params:
+        return '{}?{}'.format(url, urllib.parse.urlencode(sorted(params.items())))
+    return url
+
+
+class RecordingSession:
+    """ Records HTTP traffic going through a session
+
+    Every response is appended to responses.jsonl in the
+    recording directory together with its status, headers
+    and how long it took. Bodies of index pages and API
+    responses are kept in bodies/. Image bodies are only
+    kept if record_images is set, otherwise just their
+    length is recorded.
+    """
+
+    def __init__(self, session, path, record_images=False):
+        self.session = session
+        self.path = os.path.join(path, '')
+        self.record_images = record_images
+        self.lock = threading.Lock()
+        self.bodies = 0
+        os.makedirs('{}bodies'.format(self.path), exist_ok=True)
+        with open('{}recording.json'.format(self.path), 'w') as recordingf:
+            json.dump({'version': 1, 'record_images': record_images,
+                       'created': str(datetime.datetime.now())}, recordingf, indent=2)
+
+    def get(self, url, **kwargs):
+        begin_time = time.time()
+        response = self.session.get(url, **kwargs)
+        key = request_key(url, kwargs.get('params'))
+        if kwargs.get('stream'):
+            return RecordedResponse(response, self, key, time.time() - begin_time)
+        self.save(key, response, response.content, response.elapsed.total_seconds(), True)
+        return response
+
+    def save(self, key, response, body, elapsed, keep_body):
+        with self.lock:
+            body_file = None
+            if keep_body:
+                body_file = 'bodies/{:08}'.format(self.bodies)
+                self.bodies += 1
+                with open(self.path + body_file, 'wb') as bodyf:
+                    bodyf.write(body)
+            record = {'url': key, 'status': response.status_code, 'encoding': response.encoding,
+                      'headers': {name.lower(): value for name, value in response.headers.items()},
+                      'elapsed': round(elapsed, 6), 'length': len(body), 'body': body_file}
+            with open('{}responses.jsonl'.format(self.path), 'a') as responsesf:
+                responsesf.write(json.dumps(record) + '\n')
+
+
+class RecordedResponse:
+    """ Streamed response that is recorded once fully read
+
+    Only the time spent waiting for the network is recorded,
+    not the time the consumer takes between chunks, e.g.
+    when throttled.
+    """
+
+    def __init__(self, response, recorder, key, header_time):
+        self.response = response
+        self.recorder = recorder
+        self.key = key
+        self.header_time = header_time  # Seconds until the headers arrived
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def iter_content(self, chunk_size=1):
+        body = bytearray()
+        elapsed = self.header_time
+        chunks = iter(self.response.iter_content(chunk_size))
+        while True:
+            begin_time = time.time()
+            chunk = next(chunks, None)
+            elapsed += time.time() - begin_time
+            if chunk is None:
+                break
+            body += chunk
+            yield chunk
+        self.recorder.save(self.key, self.response, body, elapsed, self.recorder.record_images)
+
+
+class ReplaySession:
+    """ Answers requests from recorded HTTP traffic
+
+    Responses are replayed in the order they have been
+    recorded for each URL, the last one is repeated once
+    they run out. Every response takes as long as it did
+    when recorded, times latency. Requests that have not
+    been recorded get a 404.
+    """
+
+    def __init__(self, path, latency=1.0):
+        self.path = os.path.join(path, '')
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.replayed = {}
+        with open('{}recording.json'.format(self.path), 'r') as recordingf:
+            self.record_images = json.load(recordingf)['record_images']
+        for record in read_history('{}responses.jsonl'.format(self.path)):
+            self.responses.setdefault(record['url'], []).append(record)
+
+    def get(self, url, **kwargs):
+        key = request_key(url, kwargs.get('params'))
+        with self.lock:
+            records = self.responses.get(key)
+            if not records:
+                return ReplayedResponse({'status': 404, 'headers': {}, 'encoding': None, 'elapsed': 0}, b'', 0)
+            index = self.replayed.get(key, 0)
+            self.replayed[key] = index + 1
+        record = records[min(index, len(records) - 1)]
+
+        if record['body'] is not None:
+            with open(self.path + record['body'], 'rb') as bodyf:
+                body = bodyf.read()
+        else:
+            # Image that was recorded without its body
+            body = bytes(record['length'])
+
+        elapsed = record['elapsed'] * self.latency
+        if kwargs.get('stream'):
+            # Spread the time over the body as it is read
+            return ReplayedResponse(record, body, elapsed)
+        time.sleep(elapsed)
+        return ReplayedResponse(record, body, 0)
+
+
+class ReplayedResponse:
+    """ The parts of requests.Response used by Konadl
+    """
+
+    def __init__(self, record, body, delay):
+        self.status_code = record['status']
+        self.headers = record['headers']
+        self.encoding = record['encoding']
+        self.content = body
+        self.delay = delay  # Spread over iter_content
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.exceptions.HTTPError('HTTP Error {}'.format(self.status_code), response=self)
+
+    def iter_content(self, chunk_size=1):
+        chunks = max(1, -(-len(self.content) // chunk_size))
+        for offset in range(0, len(self.content) or 1, chunk_size):
+            time.sleep(self.delay / chunks)
+            chunk = self.content[offset:offset + chunk_size]
+            if chunk:
+                yield chunk
+
+    def close(self):
+        pass
+
+
+class SamplingProfiler:
+    """ Samples the stacks of all other threads
+
+    Counts how often each stack is seen, keyed by thread
+    name. dump() writes them in the collapsed format
+    read by flame graph tools.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.name = 'Sampler'
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        ignored = (threading.get_ident(), threading.main_thread().ident)
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident in ignored:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append('{}:{}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ';'.join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def dump(self, path):
+        with open(path, 'w') as samplesf:
+            for stack, count in sorted(self.samples.items()):
+                samplesf.write('{} {}\n'.format(stack, count))
+
+
+class NoLock:
+    """ Stands in for a lock or semaphore that is not used
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class RateLimiter:
+    """ Token bucket limiting bytes per second
+
+    Threads call consume() with the amount of bytes they
+    have just received and are put to sleep for as long
+    as it takes the bucket to refill. A rate of 0 means
+    no limit. The rate may be changed at any time.
+    """
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.allowance = 0
+        self.last_check = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        rate = self.rate
+        if not rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            # Allow bursts of at most one second worth of data
+            self.allowance = min(rate, self.allowance + (now - self.last_check) * rate)
+            self.last_check = now
+            self.allowance -= amount
+            wait = -self.allowance / rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class RunStats:
+    """ Counters and stage timings of a single run
+
+    Worker threads count events with count() and add the
+    time spent in a stage with timed(). The totals end up
+    as one record in the history file of the storage.
+    """
+
+    COUNTERS = ('pages', 'images', 'bytes', 'retries', 'http_429', 'verification_failures', 'dead_letters')
+    STAGES = ('crawl', 'download', 'verify')
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.stages = dict.fromkeys(self.STAGES, 0.0)
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def timed(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] += seconds
+
+    def record(self, **fields):
+        """ Builds the history record of the run
+
+        Stage timings are summed over all threads of a
+        stage, so they may exceed the duration of the run.
+        """
+        ended = time.time()
+        record = {
+            'started': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'ended': datetime.datetime.fromtimestamp(ended).isoformat(timespec='seconds'),
+            'duration': round(ended - self.started, 3),
+        }
+        record.update(fields)
+        with self.lock:
+            record.update(self.counters)
+            record['stages'] = {stage: round(seconds, 3) for stage, seconds in self.stages.items()}
+        return record
+
+
+def read_history(path):
+    """ Reads the records of a history file
+
+    Also used for the dead letter file, which has the
+    same one JSON record per line format. Lines that can
+    not be parsed (e.g. cut short by a crash) are skipped.
+    """
+    records = []
+    try:
+        with open(path, 'r') as historyf:
+            for line in historyf:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def summarize_history(records, window=10):
+    """ Summarizes the throughput of the recorded runs
+
+    Returns the rates of every run together with the
+    median rate of the previous runs (up to window of
+    them), so that a slow run stands out.
+    """
+    rows = []
+    for number, record in enumerate(records):
+        duration = record['duration'] or 1e-9
+        row = {
+            'started': record['started'],
+            'status': record['status'],
+            'images': record['images'],
+            'bytes': record['bytes'],
+            'duration': record['duration'],
+            'retries': record['retries'],
+            'http_429': record['http_429'],
+            'images_per_second': record['images'] / duration,
+            'bytes_per_second': record['bytes'] / duration,
+        }
+        previous = sorted(r['bytes_per_second'] for r in rows[-window:] if r['images'])
+        row['median_bytes_per_second'] = previous[len(previous) // 2] if previous else None
+        rows.append(row)
+    return rows
+
+
 def print_locker(function):
     """ Prevents printing formating error
 
@@ -77,6 +655,578 @@ def print_locker(function):
     return wrapper
 
 
+class Post:
+    """ A post found on an index page
+
+    Holds everything the downloader needs to know
+    about a post. Slots keep millions of queued posts
+    reasonably small.
+    """
+
+    __slots__ = ('id', 'url', 'page', 'rating', 'variant', 'attempts')
+
+    # Image variants from largest to smallest
+    VARIANTS = ('original', 'jpeg', 'sample', 'preview')
+
+    def __init__(self, post_id, url, page, rating, variant='original', attempts=0):
+        self.id = post_id
+        self.url = url
+        self.page = page
+        self.rating = rating
+        self.variant = variant
+        self.attempts = attempts  # Failed downloads so far
+
+    def __repr__(self):
+        return 'Post(id={}, page={}, rating={}, variant={})'.format(self.id, self.page, self.rating, self.variant)
+
+    @property
+    def file_name(self):
+        # Name of the image file on disk
+        return self.url.split('/')[-1].replace('%20', '_').replace('_-_', '_')
+
+    @property
+    def md5(self):
+        # Image URLs look like https://host/image/<md5>/<file name>,
+        # other variants are named after the md5 of the original
+        md5 = self.url.split('/')[-2]
+        if len(md5) == 32 and self.variant == 'original':
+            return md5
+        return None
+
+
+class PostQueue(Queue):
+    """ Queue of posts stored in flat arrays
+
+    Holding millions of Post objects takes a lot of
+    memory, so posts are broken down as they are put
+    into the queue and rebuilt when they are taken out.
+    The image URL prefix (e.g. https://konachan.com/image/)
+    is interned, the md5 directory is stored as 16 raw
+    bytes and only the file name is kept as text.
+    """
+
+    RATINGS = ('safe', 'questionable', 'explicit')
+    HAS_MD5 = 0x80  # Flag in the ratings array
+    MAGIC = b'KDLQ'
+    VERSION = 3
+
+    def _init(self, maxsize):
+        self.prefixes = []
+        self.prefix_indices = {}
+        self.ids = array('I')
+        self.pages = array('I')
+        self.ratings = array('B')
+        self.variants = array('B')
+        self.attempts = array('B')
+        self.prefix_ids = array('I')
+        self.md5s = bytearray()
+        self.suffix_offsets = array('Q')
+        self.suffixes = bytearray()
+        self.suffix_base = 0  # Offset of suffixes[0]
+        self.head = 0  # Index of the next post to get
+
+    def _qsize(self):
+        return len(self.ids) - self.head
+
+    def _put(self, post):
+        directory, file_name = post.url.rsplit('/', 1)
+        prefix, md5 = directory.rsplit('/', 1)
+        rating = self.RATINGS.index(post.rating)
+        try:
+            md5 = bytes.fromhex(md5) if len(md5) == 32 else None
+        except ValueError:
+            md5 = None
+        if md5 is None:
+            prefix = directory
+            md5 = bytes(16)
+        else:
+            rating |= self.HAS_MD5
+
+        if prefix not in self.prefix_indices:
+            self.prefix_indices[prefix] = len(self.prefixes)
+            self.prefixes.append(prefix)
+
+        self.ids.append(post.id)
+        self.pages.append(post.page)
+        self.ratings.append(rating)
+        self.variants.append(Post.VARIANTS.index(post.variant))
+        self.attempts.append(min(post.attempts, 255))
+        self.prefix_ids.append(self.prefix_indices[prefix])
+        self.md5s += md5
+        self.suffix_offsets.append(self.suffix_base + len(self.suffixes))
+        self.suffixes += file_name.encode()
+
+    def _get(self):
+        index = self.head
+        self.head += 1
+        start = self.suffix_offsets[index] - self.suffix_base
+        if self.head < len(self.ids):
+            end = self.suffix_offsets[self.head] - self.suffix_base
+        else:
+            end = len(self.suffixes)
+
+        rating = self.ratings[index]
+        url = self.prefixes[self.prefix_ids[index]]
+        if rating & self.HAS_MD5:
+            url = '{}/{}'.format(url, self.md5s[index * 16:index * 16 + 16].hex())
+        url = '{}/{}'.format(url, self.suffixes[start:end].decode())
+        post = Post(self.ids[index], url, self.pages[index], self.RATINGS[rating & ~self.HAS_MD5],
+                    Post.VARIANTS[self.variants[index]], self.attempts[index])
+
+        # Drop posts already taken out once they make up
+        # half of the arrays, so that memory is given back
+        if self.head >= 4096 and self.head * 2 >= len(self.ids):
+            self.compact()
+        return post
+
+    def compact(self):
+        # Removes posts that have already been taken out
+        head = self.head
+        if head < len(self.ids):
+            new_base = self.suffix_offsets[head]
+        else:
+            new_base = self.suffix_base + len(self.suffixes)
+        del self.suffixes[:new_base - self.suffix_base]
+        self.suffix_base = new_base
+        del self.md5s[:head * 16]
+        for name in ('ids', 'pages', 'ratings', 'variants', 'attempts', 'prefix_ids', 'suffix_offsets'):
+            del getattr(self, name)[:head]
+        self.head = 0
+
+    def save(self, file):
+        """ Writes the queued posts to a binary file
+
+        The arrays are dumped as they are, which is a lot
+        faster and smaller than pickling Post objects.
+        """
+        with self.mutex:
+            self.compact()
+            file.write(struct.pack('<4sBBIIQ', self.MAGIC, self.VERSION, sys.byteorder == 'big',
+                                   len(self.ids), len(self.prefixes), self.suffix_base))
+            for prefix in self.prefixes:
+                prefix = prefix.encode()
+                file.write(struct.pack('<H', len(prefix)))
+                file.write(prefix)
+            for values in (self.ids, self.pages, self.ratings, self.variants, self.attempts, self.prefix_ids,
+                           self.suffix_offsets):
+                values.tofile(file)
+            file.write(self.md5s)
+            file.write(struct.pack('<Q', len(self.suffixes)))
+            file.write(self.suffixes)
+
+    @classmethod
+    def load(cls, file):
+        """ Reads posts written by save() into a new queue
+        """
+        queue = cls()
+        magic, version, big_endian, length, prefixes, suffix_base = struct.unpack(
+            '<4sBBIIQ', file.read(struct.calcsize('<4sBBIIQ')))
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError('Not a post queue file')
+
+        for _ in range(prefixes):
+            prefix_length, = struct.unpack('<H', file.read(2))
+            queue.prefixes.append(file.read(prefix_length).decode())
+        queue.prefix_indices = {prefix: index for index, prefix in enumerate(queue.prefixes)}
+        for values in (queue.ids, queue.pages, queue.ratings, queue.variants, queue.attempts, queue.prefix_ids,
+                       queue.suffix_offsets):
+            values.fromfile(file, length)
+            if big_endian != (sys.byteorder == 'big'):
+                values.byteswap()
+        queue.md5s = bytearray(file.read(length * 16))
+        suffixes_length, = struct.unpack('<Q', file.read(8))
+        queue.suffixes = bytearray(file.read(suffixes_length))
+        queue.suffix_base = suffix_base
+        queue.unfinished_tasks = length
+        return queue
+
+
+class FlatLayout:
+    """ Stores every image directly in the storage root
+    """
+
+    def key(self, post):
+        return post.file_name
+
+
+class HashPrefixLayout:
+    """ Shards images by the hash of their file names
+
+    With the default settings an image is stored as
+    ab/cd/<file name>, which spreads a mirror over 65536
+    directories of roughly equal size.
+    """
+
+    def __init__(self, depth=2, width=2):
+        self.depth = depth
+        self.width = width
+
+    def key(self, post):
+        file_name = post.file_name
+        digest = hashlib.md5(file_name.encode()).hexdigest()
+        shards = [digest[i * self.width:(i + 1) * self.width] for i in range(self.depth)]
+        return '{}/{}'.format('/'.join(shards), file_name)
+
+
+class IdRangeLayout:
+    """ Buckets images by ranges of post ids
+
+    Posts 0 to 9999 go into 0000/, 10000 to 19999 into
+    0001/ and so on, so neighbouring posts stay together.
+    """
+
+    def __init__(self, bucket_size=10000):
+        self.bucket_size = bucket_size
+
+    def key(self, post):
+        return '{:04d}/{}'.format(post.id // self.bucket_size, post.file_name)
+
+
+LAYOUTS = {'flat': FlatLayout, 'hash': HashPrefixLayout, 'id': IdRangeLayout}
+
+
+class Sink(ABC):
+    """ Where downloaded images are stored
+
+    Sinks are keyed by a relative path made of the image
+    variant folder, the post's rating folder (if images are
+    separated by ratings) and the location given by the
+    layout. Subclass this to store images somewhere other
+    than the local filesystem.
+    """
+
+    def __init__(self, separate=False, layout=None):
+        self.separate = separate
+        self.layout = layout or FlatLayout()
+
+    def key(self, post):
+        # Relative location of the post's image, variants
+        # other than the original get a folder of their own
+        key = self.layout.key(post)
+        if self.separate:
+            key = '{}/{}'.format(post.rating, key)
+        if post.variant != 'original':
+            key = '{}/{}'.format(post.variant, key)
+        return key
+
+    @abstractmethod
+    def exists(self, post):
+        pass
+
+    @abstractmethod
+    def write(self, post, content):
+        """ Stores the image of a post
+
+        Returns the location the image was written to.
+        """
+
+    @abstractmethod
+    def remove(self, post):
+        pass
+
+
+class FileSystemSink(Sink):
+    """ Stores images in the storage directory
+
+    Subdirectories required by the layout are created
+    on demand and remembered, so each one is only
+    checked once per run.
+
+    io_policy is one of IO_POLICIES:
+        buffered: plain writes through the page cache
+        dontneed: preallocate the file and drop its pages
+            from the page cache once written
+        direct: like dontneed, but write the bulk of the
+            file with O_DIRECT, bypassing the page cache
+    Whatever the platform does not support is skipped.
+    """
+
+    IO_POLICIES = ('buffered', 'dontneed', 'direct')
+    DIRECT_ALIGNMENT = 4096
+    DIRECT_CHUNK = 1048576
+
+    def __init__(self, storage, separate=False, layout=None, io_policy='buffered'):
+        Sink.__init__(self, separate, layout)
+        self.storage = storage
+        self.directories = set()
+        self.io_policy = io_policy
+
+    def path(self, post):
+        return '{}{}'.format(self.storage, self.key(post))
+
+    def exists(self, post):
+        return os.path.isfile(self.path(post))
+
+    def write(self, post, content):
+        file_path = self.path(post)
+        directory = os.path.dirname(file_path)
+        if directory not in self.directories:
+            os.makedirs(directory, exist_ok=True)
+            self.directories.add(directory)
+        if self.io_policy == 'buffered':
+            with open(file_path, 'wb') as file:
+                file.write(content)
+        else:
+            self.write_uncached(file_path, content)
+        return file_path
+
+    def write_uncached(self, file_path, content):
+        """ Writes a file without leaving it in the page cache
+
+        The file is preallocated to its final size so that it
+        is laid out in one piece, synced and then dropped from
+        the page cache.
+        """
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            if content and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(fd, 0, len(content))
+                except OSError:
+                    pass  # Not supported by the file system
+
+            written = 0
+            if self.io_policy == 'direct':
+                written = self.write_direct(file_path, content)
+            view = memoryview(content)
+            while written < len(content):
+                written += os.pwrite(fd, view[written:], written)
+
+            if hasattr(os, 'fdatasync'):
+                os.fdatasync(fd)
+            if hasattr(os, 'posix_fadvise'):
+                # Dirty pages are not dropped, hence the sync above
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+    def write_direct(self, file_path, content):
+        """ Writes the aligned part of a file with O_DIRECT
+
+        O_DIRECT needs buffers, offsets and lengths aligned
+        to the block size, so the content is copied through
+        a page aligned mmap buffer in large chunks. Returns
+        how many bytes have been written; the unaligned tail
+        is left for a regular write.
+        """
+        aligned = len(content) // self.DIRECT_ALIGNMENT * self.DIRECT_ALIGNMENT
+        if not aligned or not hasattr(os, 'O_DIRECT'):
+            return 0
+        try:
+            fd = os.open(file_path, os.O_WRONLY | os.O_DIRECT)
+        except OSError:
+            return 0  # e.g. tmpfs does not support O_DIRECT
+        buffer = mmap.mmap(-1, self.DIRECT_CHUNK)
+        view = memoryview(buffer)
+        written = 0
+        try:
+            while written < aligned:
+                length = min(self.DIRECT_CHUNK, aligned - written)
+                view[:length] = content[written:written + length]
+                written += os.write(fd, view[:length])
+        except OSError:
+            # Whatever has not been written is rewritten normally
+            written = written // self.DIRECT_ALIGNMENT * self.DIRECT_ALIGNMENT
+        finally:
+            view.release()
+            buffer.close()
+            os.close(fd)
+        return written
+
+    def remove(self, post):
+        # Best effort, an image left behind is overwritten
+        # when the post is downloaded again
+        try:
+            os.remove(self.path(post))
+        except OSError:
+            pass
+
+
+class MemorySink(Sink):
+    """ Keeps images in memory
+
+    Useful when images are consumed straight away
+    through Konadl.on_downloaded and never need to
+    touch the disk.
+    """
+
+    def __init__(self, separate=False, layout=None):
+        Sink.__init__(self, separate, layout)
+        self.images = {}
+        self.lock = threading.Lock()
+
+    def exists(self, post):
+        return self.key(post) in self.images
+
+    def write(self, post, content):
+        key = self.key(post)
+        with self.lock:
+            self.images[key] = bytes(content)
+        return key
+
+    def remove(self, post):
+        with self.lock:
+            self.images.pop(self.key(post), None)
+
+
+class NullSink(Sink):
+    """ Throws images away
+
+    Used when replaying recorded traffic, where only the
+    pipeline is of interest and keeping every image in
+    memory would only skew the measurements.
+    """
+
+    def exists(self, post):
+        return False
+
+    def write(self, post, content):
+        return self.key(post)
+
+    def remove(self, post):
+        pass
+
+
+class BucketSink(Sink):
+    """ Stores images as objects of a bucket
+
+    Object keys are the keys of Sink below an
+    optional prefix, e.g. "konachan/".
+    """
+
+    def __init__(self, bucket, prefix='', separate=False, layout=None):
+        Sink.__init__(self, separate, layout)
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def key(self, post):
+        return '{}{}'.format(self.prefix, Sink.key(self, post))
+
+
+class ObjectStoreSink(BucketSink):
+    """ Stores images in an object store bucket
+
+    Works with any client exposing boto3 style
+    put_object, head_object and delete_object methods.
+    """
+
+    # Error codes of boto3 style clients for missing objects
+    MISSING_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+    def __init__(self, client, bucket, prefix='', separate=False, layout=None):
+        BucketSink.__init__(self, bucket, prefix, separate, layout)
+        self.client = client
+
+    def exists(self, post):
+        # Only a missing object means the image is not stored,
+        # other errors such as failed authentication are raised
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(post))
+            return True
+        except Exception as e:
+            response = getattr(e, 'response', None)
+            if isinstance(response, dict) and response.get('Error', {}).get('Code') in self.MISSING_CODES:
+                return False
+            raise
+
+    def write(self, post, content):
+        key = self.key(post)
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=bytes(content))
+        return key
+
+    def remove(self, post):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(post))
+
+
+class S3Sink(BucketSink):
+    """ Stores images in an S3 compatible bucket
+
+    Talks to the endpoint directly with path style
+    URLs and AWS signature version 4, so it works with
+    MinIO, Ceph and other S3 compatible servers without
+    requiring boto3.
+    """
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region='us-east-1',
+                 prefix='', separate=False, layout=None):
+        BucketSink.__init__(self, bucket, prefix, separate, layout)
+        self.endpoint = endpoint.rstrip('/')
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.session = None
+
+    @classmethod
+    def from_environment(cls, endpoint, bucket, region='us-east-1', separate=False, layout=None):
+        """ Creates a sink with credentials from the environment
+
+        Reads AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY
+        like other S3 tools do.
+        """
+        return cls(endpoint, bucket, os.environ.get('AWS_ACCESS_KEY_ID', ''),
+                   os.environ.get('AWS_SECRET_ACCESS_KEY', ''), region, separate=separate, layout=layout)
+
+    def request(self, method, key, content=b''):
+        """ Sends a signed request for an object
+        """
+        if self.session is None:
+            import requests
+            self.session = requests.Session()
+
+        path = '/{}/{}'.format(self.bucket, urllib.parse.quote(key, safe='/-_.~'))
+        headers = self.sign(method, path, '', content, datetime.datetime.now(datetime.timezone.utc))
+        return self.session.request(method, '{}{}'.format(self.endpoint, path), headers=headers, data=content)
+
+    def sign(self, method, path, query, content, now):
+        """ Signs a request with AWS signature version 4
+
+        path and query have to be URI encoded and query
+        in canonical form already. Returns the headers to
+        send along with the request.
+        """
+        host = urllib.parse.urlparse(self.endpoint).netloc
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        scope = '{}/{}/s3/aws4_request'.format(now.strftime('%Y%m%d'), self.region)
+        payload_hash = hashlib.sha256(content).hexdigest()
+
+        # Build the canonical request and sign it
+        signed_headers = 'host;x-amz-content-sha256;x-amz-date'
+        canonical_request = '\n'.join([
+            method, path, query,
+            'host:{}\nx-amz-content-sha256:{}\nx-amz-date:{}\n'.format(host, payload_hash, amz_date),
+            signed_headers, payload_hash])
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest()])
+        signing_key = ('AWS4' + self.secret_key).encode()
+        for part in (now.strftime('%Y%m%d'), self.region, 's3', 'aws4_request', string_to_sign):
+            signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+        signature = signing_key.hex()
+
+        return {
+            'x-amz-date': amz_date,
+            'x-amz-content-sha256': payload_hash,
+            'Authorization': 'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+                self.access_key, scope, signed_headers, signature),
+        }
+
+    def exists(self, post):
+        return self.request('HEAD', self.key(post)).status_code == 200
+
+    def write(self, post, content):
+        key = self.key(post)
+        self.request('PUT', key, bytes(content)).raise_for_status()
+        return '{}/{}/{}'.format(self.endpoint, self.bucket, key)
+
+    def remove(self, post):
+        # Best effort like FileSystemSink.remove, requests
+        # raises subclasses of OSError for network failures
+        try:
+            self.request('DELETE', self.key(post))
+        except OSError:
+            pass
+
+
 class Konadl:
     """
     Konachan Downloader
@@ -97,6 +1247,7 @@ class Konadl:
         self.VERSION = '1.9.0'
         self.storage = '/tmp/konachan/'
         self.separate = False
+        self.layout = 'flat'  # One of the keys of LAYOUTS
         self.total_downloads = 0
         self.pages = False
         self.crawl_all = False
@@ -106,11 +1257,45 @@ class Konadl:
         self.questionable = False
         self.current_newest_id = False
         self.previous_newest_id = False
+        self.stop_id = None  # Posts up to this id are skipped when updating
+        self.last_page = False
         self.post_crawler_threads_amount = 10
         self.downloader_threads_amount = 20
+        self.verifier_threads_amount = 4
+        self.verify = True  # Check downloaded images against their md5
+        self.verify_images = False  # Also check that images are not truncated
+        self.variant = 'original'  # One of Post.VARIANTS, or 'largest'
+        self.max_image_size = 0  # Largest image size in bytes when variant is 'largest'
+        self.skip_existing = True  # Do not download images that are already stored
+        self.downloaded_md5s = set()
+        self.bandwidth_limit = 0  # Bytes per second shared by all threads, 0 for unlimited
+        self.host_bandwidth_limits = {}  # Bytes per second for specific hosts
+        self.bandwidth_schedule = []  # (start, end, bytes per second) with times as 'HH:MM'
+        self.bandwidth_limiter = RateLimiter()
+        self.host_bandwidth_limiters = {}
+        self.bandwidth_lock = threading.Lock()
+        self.shared_bandwidth_limiter = None  # RateLimiter shared with other Konadl objects
+        self.request_slots = None  # Semaphore shared with other Konadl objects
         self.job_done = False
         self.load_progress = False
         self.error_logs_file = False
+        self.session = None
+        self.cancelled = threading.Event()
+        self.tracker = None
+        self.stats = RunStats()
+        self.sink = None  # Defaults to a FileSystemSink in self.storage
+        self.io_policy = 'buffered'  # One of FileSystemSink.IO_POLICIES
+        self.max_attempts = 5  # Failed attempts before a job goes to the dead letter file
+        self.retry_backoff = 1.0  # Seconds before the first retry, doubled on every failed attempt
+        self.rate_limit_backoff = 30.0  # Seconds to back off after a 429 without Retry-After
+        self.record = None  # Directory to record HTTP traffic to
+        self.record_images = False  # Also record image bodies
+        self.replay = None  # Directory to replay recorded HTTP traffic from
+        self.replay_latency = 1.0  # Factor applied to recorded response times
+        self.profile = None  # 'cprofile' or 'sample' to profile worker threads
+        self.profile_interval = 0.005  # Seconds between samples
+        self.sampler = None
+        self.on_downloaded = None  # Called as on_downloaded(post, location, length, elapsed)
         self.headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) \
                         AppleWebKit/537.36 (KHTML, like Gecko) Chrome/65.0.3325.181 \
                         Safari/537.36'}
@@ -150,6 +1335,126 @@ class Konadl:
                 error_file.close()
             self.error_log_lock.release()
 
+    def get(self, url, **kwargs):
+        """ Sends a GET request
+
+        All requests go through a shared session so that
+        connections are pooled between threads. If
+        self.request_slots is set, it limits how many requests
+        may be in flight at once.
+        """
+        if self.session is None:
+            self.prepare_session()
+
+        # Streamed requests hold their slot until the body is read,
+        # which is up to the caller (see Konadl.download)
+        if self.request_slots is None or kwargs.get('stream'):
+            return self.session.get(url, **kwargs)
+        with self.request_slots:
+            return self.session.get(url, **kwargs)
+
+    def prepare_session(self):
+        """ Creates the session all requests go through
+
+        Wraps it to record traffic if self.record is set,
+        or answers requests from recorded traffic instead if
+        self.replay is set. Images replayed without a recorded
+        body are placeholders, so verifying them is skipped.
+        """
+        if self.replay:
+            self.session = ReplaySession(self.replay, self.replay_latency)
+            if not self.session.record_images:
+                self.verify = False
+                self.verify_images = False
+            return
+        self.session = make_session(
+            self.headers, self.post_crawler_threads_amount + self.downloader_threads_amount)
+        if self.record:
+            self.session = RecordingSession(self.session, self.record, self.record_images)
+
+    def current_bandwidth_limit(self):
+        """ Returns the global bandwidth limit in effect now
+
+        The first window of self.bandwidth_schedule which
+        contains the current time wins. Windows may wrap
+        around midnight, e.g. ('22:00', '06:00', 0).
+        """
+        now = datetime.datetime.now().strftime('%H:%M')
+        for start, end, rate in self.bandwidth_schedule:
+            if start <= end:
+                if start <= now < end:
+                    return rate
+            elif now >= start or now < end:
+                return rate
+        return self.bandwidth_limit
+
+    def throttle(self, url, amount):
+        """ Accounts for bytes received from a URL
+
+        Blocks until both the global limit and the limit
+        of the URL's host allow the bytes through.
+        """
+        self.bandwidth_limiter.rate = self.current_bandwidth_limit()
+        self.bandwidth_limiter.consume(amount)
+        if self.shared_bandwidth_limiter is not None:
+            self.shared_bandwidth_limiter.consume(amount)
+
+        host = urllib.parse.urlparse(url).hostname
+        if host in self.host_bandwidth_limits:
+            with self.bandwidth_lock:
+                if host not in self.host_bandwidth_limiters:
+                    self.host_bandwidth_limiters[host] = RateLimiter()
+                limiter = self.host_bandwidth_limiters[host]
+            limiter.rate = self.host_bandwidth_limits[host]
+            limiter.consume(amount)
+
+    def download(self, url):
+        """ Downloads a file while applying bandwidth limits
+
+        The response is streamed in chunks and every chunk
+        is throttled. Raises Cancelled if the crawl is
+        cancelled halfway. Returns the response and its content.
+        """
+        with self.request_slots or NoLock():
+            response = self.get(url, stream=True)
+            content = bytearray()
+            for chunk in response.iter_content(65536):
+                if self.cancelled.is_set():
+                    response.close()
+                    raise Cancelled
+                content += chunk
+                self.throttle(url, len(chunk))
+        return response, bytes(content)
+
+    def get_index_page(self, page):
+        # Index pages count towards the bandwidth limits as well
+        url = '{}/post?page={}&tags='.format(self.site_root, page)
+        page_source = self.get(url)
+        self.throttle(url, len(page_source.content))
+        return page_source
+
+    def rating_tags(self):
+        """ Returns the search tags for the desired ratings
+
+        Returns an empty string if every rating is wanted,
+        or None if no rating is wanted at all.
+        """
+        ratings = []
+        if self.safe:
+            ratings.append('s')
+        if self.questionable:
+            ratings.append('q')
+        if self.explicit:
+            ratings.append('e')
+        if not ratings:
+            return None
+        elif len(ratings) == 3:
+            return ''
+        elif len(ratings) == 1:
+            return 'rating:{}'.format(ratings[0])
+        missing = ({'s', 'q', 'e'} - set(ratings)).pop()
+        return '-rating:{}'.format(missing)
+
     def process_crawling_options(self):
         """ Processes crawling options
 
@@ -160,6 +1465,118 @@ class Konadl:
         if self.yandere:
             self.site_root = 'https://yande.re'
 
+    def prepare_sink(self):
+        # Store images in the storage directory unless
+        # another sink has been supplied. Replayed images are
+        # thrown away, nor do images already in the storage count
+        if self.replay:
+            self.skip_existing = False
+            if self.sink is None:
+                self.sink = NullSink(self.separate, LAYOUTS[self.layout]())
+        if self.sink is None:
+            self.sink = FileSystemSink(self.storage, self.separate, LAYOUTS[self.layout](), self.io_policy)
+
+    def wanted_ratings(self):
+        # Maps the rating names used in alt texts to the
+        # ratings that are to be downloaded
+        wanted = {'Safe': self.safe, 'Questionable': self.questionable, 'Explicit': self.explicit}
+        return {name: RATING_NAMES[name] for name, included in wanted.items() if included}
+
+    def extract_posts(self, page_source, page):
+        """ Finds posts on an index page
+
+        Returns a list of every post on the page whose
+        rating is one of the desired ratings, pointing to
+        the image variant selected by self.variant.
+        """
+        ratings = self.wanted_ratings()
+        post_data = {}
+        if self.variant != 'original':
+            post_data = self.extract_post_data(page_source)
+
+        page_posts = []
+        for match in POST_PATTERN.finditer(page_source):
+            rating = ratings.get(match.group(3))
+            if rating is None:
+                continue
+            post_id = int(match.group(1))
+            url = HREF_PATTERN.search(match.group(4)).group(1)
+            variant = 'original'
+
+            if post_id in post_data:
+                variant, url = self.choose_variant(post_data[post_id])
+            elif self.variant in ('preview', 'largest'):
+                # Without post data the size of the original is not
+                # known either, so "largest" gets the preview too
+                variant, url = 'preview', None
+            if url is None:
+                # The thumbnail is all that is known about the preview
+                url = SRC_PATTERN.search(match.group(2)).group(1)
+
+            # Links are protocol relative on some sites
+            if url.startswith('//'):
+                url = 'https:{}'.format(url)
+            page_posts.append(Post(post_id, url, page, rating, variant))
+        return page_posts
+
+    def extract_post_data(self, page_source):
+        # Returns the JSON data embedded for every post by id
+        post_data = {}
+        for match in POST_DATA_PATTERN.finditer(page_source):
+            try:
+                data = json.loads(match.group(1))
+            except ValueError:
+                continue
+            for post in data.get('posts', [data]):
+                if 'id' in post:
+                    post_data[post['id']] = post
+        return post_data
+
+    def choose_variant(self, data):
+        """ Picks the image variant to download for a post
+
+        Returns the variant and its URL. With the variant
+        set to "largest", the largest variant that is at most
+        self.max_image_size bytes is picked, falling back to
+        the preview, whose URL is None if it is not in the data.
+        """
+        urls = {
+            'original': (data.get('file_url'), data.get('file_size')),
+            'jpeg': (data.get('jpeg_url'), data.get('jpeg_file_size')),
+            'sample': (data.get('sample_url'), data.get('sample_file_size')),
+            'preview': (data.get('preview_url'), 0),
+        }
+        if self.variant == 'largest':
+            for variant in Post.VARIANTS:
+                url, size = urls[variant]
+                if url and (variant == 'preview' or (size and size <= self.max_image_size)):
+                    return variant, url
+            return 'preview', None
+        elif urls[self.variant][0]:
+            return self.variant, urls[self.variant][0]
+        return 'original', urls['original'][0]
+
+    def already_downloaded(self, post):
+        # Checks the verified images index first,
+        # which saves a lookup in the sink for most posts
+        return post.md5 in self.downloaded_md5s or self.sink.exists(post)
+
+    def iter_posts(self, pages=False):
+        """ Generates posts from the index pages
+
+        Yields every post with a desired rating, page by
+        page, without downloading anything. Crawls all pages
+        if the number of pages is not specified.
+        """
+        self.process_crawling_options()
+        if not pages:
+            pages = self.get_total_pages()
+        for page in range(1, pages + 1):
+            page_source = self.get_index_page(page)
+            page_source.raise_for_status()
+            for post in self.extract_posts(page_source.text, page):
+                yield post
+
     def crawl(self):
         """ Generic crawling
 
@@ -173,88 +1590,27 @@ class Konadl:
         # Initialize page queue and downloader queue
         copyreg.pickle(Queue, pickle_queue, unpickle_queue)
         self.post_queue = Queue()
-        self.download_queue = Queue()
-        # Prepare containers for threads
-        self.page_threads = []
-        self.downloader_threads = []
-
-        self.print_lock = threading.Lock()
-        self.error_log_lock = threading.Lock()
-        self.abort = False
+        self.download_queue = PostQueue()
+        self.prepare_pipeline()
 
         # load progress from progress file if needed
         if self.load_progress:
             self.read_queues()
-
-        try:
-            self.current_newest_id = self.get_newest_image_id()
-
-            # Create post crawler threads
-            for identifier in range(self.post_crawler_threads_amount):
-                thread = threading.Thread(target=self.crawl_post_page_worker)
-                thread.name = 'Post Crawler {}'.format(identifier)
-                thread.start()
-                self.page_threads.append(thread)
-
-            # Create image downloader threads
-            for identifier in range(self.downloader_threads_amount):
-                thread = threading.Thread(
-                    target=self.retrieve_post_image_worker)
-                thread.name = 'Downloader {}'.format(identifier)
-                thread.start()
-                self.downloader_threads.append(thread)
-
+            # Every job in the restored queues is still outstanding,
+            # since jobs in flight are put back before saving
+            self.tracker.add(self.post_queue.qsize() + self.download_queue.qsize())
+        else:
             # Every page is a job in the queue
-            if not self.load_progress:
-                for page_num in range(1, self.pages + 1):
-                    self.post_queue.put(page_num)
-
-            # Wait for all jobs to be done
-            # We are not using Queue.join() since if the session is restored,
-            # Queue will not join even when all jobs are done.
-            if self.load_progress:
-                while not self.post_queue.empty() or not self.download_queue.empty():
-                    time.sleep(0.1)  # Make each tick longer than pass
-            else:
-                self.post_queue.join()
-                self.download_queue.join()
-
-            # Send exit signal to all threads
-            for _ in range(self.post_crawler_threads_amount):
-                self.post_queue.put(None)
-            for _ in range(self.downloader_threads_amount):
-                self.download_queue.put((None, None, None))
-
-            for thread in self.page_threads:
-                thread.join()
-            for thread in self.downloader_threads:
-                thread.join()
-
-            self.job_done = True
-            self.save_metadata()
-            return True  # Job entirely done
-        except (KeyboardInterrupt, SystemExit):
-            # Main thread catches KeyboardInterrupt
-            # Clear queues and put None as exit signal
-            self.warn_keyboard_interrupt()
-            self.abort = True
-            if not self.download_queue.empty():
-                self.save_queues()
-
-            self.post_queue.queue.clear()
-            for _ in range(self.post_crawler_threads_amount):
-                self.post_queue.put(None)
-            self.download_queue.queue.clear()
-            for _ in range(self.downloader_threads_amount):
-                self.download_queue.put((None, None, None))
-
-            for thread in self.page_threads:
-                thread.join()
-            for thread in self.downloader_threads:
-                thread.join()
-
-            self.save_metadata()
-            return False  # Job paused
+            self.tracker.add(self.pages)
+            for page_num in range(1, self.pages + 1):
+                self.post_queue.put(page_num)
+        self.prepare_sink()
+        if self.load_progress and self.stop_id is not None:
+            # Resuming an update, which already knows its newest post
+            self.current_newest_id = self.previous_newest_id
+        else:
+            self.current_newest_id = self.get_newest_image_id()
+        return self.run_pipeline()
 
     def crawl_page(self, page_num):
         """ [OUTDATED] Crawl a specific page
@@ -280,61 +1636,183 @@ class Konadl:
         return self.crawl()
 
     def update(self):
+        """ Download images posted since the last run
+
+        Checks the newest post id with a single lightweight
+        request first, so that runs with nothing new to fetch
+        return without starting any threads. New posts are
+        then crawled by the same pipeline as crawl(), stopping
+        at the newest post of the previous run.
+        """
         self.process_crawling_options()
         self.read_metadata()
+        self.stats = RunStats()
         self.current_newest_id = self.get_newest_image_id()
+
+        if self.current_newest_id == self.previous_newest_id:
+            self.append_history('up to date', mode='update')
+            return False
+
         self.error_logs_file = '{}errors.log'.format(self.storage)
+        self.prepare_sink()
 
         # Initialize page queue and downloader queue
+        copyreg.pickle(Queue, pickle_queue, unpickle_queue)
         self.post_queue = Queue()
-        self.download_queue = Queue()
-        # Prepare containers for threads
-        self.downloader_threads = []
-
-        self.print_lock = threading.Lock()
-        self.error_log_lock = threading.Lock()
-
-        if self.get_newest_image_id() == self.previous_newest_id:
-            return False
+        self.download_queue = PostQueue()
+        self.prepare_pipeline()
+
+        # Only posts newer than the stop id are downloaded
+        self.stop_id = 0
+        if self.previous_newest_id:
+            self.stop_id = int(self.previous_newest_id[1:])
+        self.last_page = self.get_total_pages()
+
+        # Start with one page per crawler thread, every crawled
+        # page then queues the page one window further
+        first_pages = range(1, min(self.post_crawler_threads_amount, self.last_page) + 1)
+        self.tracker.add(len(first_pages))
+        for page_num in first_pages:
+            self.post_queue.put(page_num)
+        return self.run_pipeline()
+
+    def run_pipeline(self):
+        """ Runs the crawler, downloader and verifier threads
+
+        Returns True once every queued job has gone through
+        the pipeline, or False if the job has been paused with
+        Ctrl+C or cancel(), in which case the progress is saved.
+        A cancel() that arrived before the run got here pauses
+        it straight away. self.cancelled is reset once a paused
+        run is saved, so the object can be used for a new run.
+        """
+        if self.skip_existing:
+            self.downloaded_md5s = set(self.read_checksums().values())
+        if self.profile == 'sample':
+            self.sampler = SamplingProfiler(self.profile_interval)
+            self.sampler.start()
 
         try:
-
-            # Create image downloader threads
-            for identifier in range(self.downloader_threads_amount):
-                thread = threading.Thread(
-                    target=self.retrieve_post_image_worker, args=(self.download_queue,))
-                thread.name = 'Downloader {}'.format(identifier)
-                thread.start()
-                self.downloader_threads.append(thread)
-
-            self.crawl_new_images()
-
-            self.download_queue.join()
-            for _ in range(self.downloader_threads_amount):
-                self.download_queue.put((None, None, None))
-            for thread in self.downloader_threads:
-                thread.join()
-            self.job_done = True
-            self.save_metadata()
-            return True
+            if not self.cancelled.is_set():
+                self.page_threads = self.start_threads(
+                    self.crawl_post_page_worker, 'Post Crawler', self.post_crawler_threads_amount)
+                self.downloader_threads = self.start_threads(
+                    self.retrieve_post_image_worker, 'Downloader', self.downloader_threads_amount)
+                self.start_verifiers()
+
+                # Wait for all jobs to go through the pipeline,
+                # or for the crawl to be cancelled
+                self.tracker.wait()
         except (KeyboardInterrupt, SystemExit):
+            # Main thread catches KeyboardInterrupt
             self.warn_keyboard_interrupt()
-            if not self.download_queue.empty():
-                self.save_queues()
-
-            self.download_queue.queue.clear()
-            for _ in range(self.downloader_threads_amount):
-                self.download_queue.put((None, None, None))
-            for thread in self.downloader_threads:
-                thread.join()
-
+            self.cancel()
+        self.stop_threads()
+        if self.sampler is not None:
+            self.sampler.stop()
+            os.makedirs('{}profiles'.format(self.storage), exist_ok=True)
+            self.sampler.dump('{}profiles/samples.txt'.format(self.storage))
+            self.sampler = None
+
+        if self.cancelled.is_set():
+            self.save_queues_if_needed()
             self.save_metadata()
+            self.append_history('paused')
+            self.cancelled.clear()
             return False  # Job paused
 
+        self.job_done = True
+        self.save_metadata()
+        self.append_history('done')
+        return True  # Job entirely done
+
+    def prepare_pipeline(self):
+        # Prepare locks, the job tracker and containers for threads
+        self.print_lock = threading.Lock()
+        self.error_log_lock = threading.Lock()
+        self.checksums_lock = threading.Lock()
+        self.verify_queue = Queue(maxsize=self.verifier_threads_amount * 4)
+        self.tracker = JobTracker()
+        self.stats = RunStats()
+        self.page_attempts = {}
+        self.attempts_lock = threading.Lock()
+        self.dead_letter_lock = threading.Lock()
+        self.frontier_page = None
+        self.frontier_lock = threading.Lock()
+        self.page_threads = []
+        self.downloader_threads = []
+        self.verifier_threads = []
+
+    def start_threads(self, target, name, amount):
+        # Start worker threads and return them
+        if self.profile == 'cprofile':
+            target = self.profiled(target)
+        threads = []
+        for identifier in range(amount):
+            thread = threading.Thread(target=target)
+            thread.name = '{} {}'.format(name, identifier)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def profiled(self, target):
+        """ Wraps a worker thread function with cProfile
+
+        Each thread writes its own profile to the profiles
+        directory in the storage once it exits.
+        """
+        import cProfile
+
+        def profiled_target():
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                target()
+            finally:
+                profile.disable()
+                os.makedirs('{}profiles'.format(self.storage), exist_ok=True)
+                profile.dump_stats('{}profiles/{}.prof'.format(
+                    self.storage, threading.current_thread().name.replace(' ', '_')))
+        return profiled_target
+
+    def stop_threads(self):
+        """ Stops all worker threads
+
+        Closes every queue, which makes the workers exit
+        once they are done with their current job, then
+        waits for them.
+        """
+        self.post_queue.close()
+        self.download_queue.close()
+        self.verify_queue.close()
+        for thread in self.page_threads + self.downloader_threads + self.verifier_threads:
+            thread.join()
+
+    def cancel(self):
+        """ Cancels the running crawl
+
+        Workers put whatever job they are working on back
+        to its queue and exit as soon as possible, so that
+        the queues can be saved and resumed later.
+        """
+        self.cancelled.set()
+        if self.tracker is not None:
+            self.post_queue.close()
+            self.download_queue.close()
+            self.verify_queue.close()
+            # Wake up the main thread waiting for the pipeline
+            self.tracker.stop()
+
+    def save_queues_if_needed(self):
+        # Saves the jobs that are left once all workers exited
+        self.requeue_unverified()
+        if self.post_queue.qsize() or self.download_queue.qsize():
+            self.save_queues()
+
     def get_total_pages(self):
         # Crawl the first post page and read the number of total pages
-        index_page = requests.get('{}/post?page=1&tags='.format(self.site_root), headers=self.headers).text
-        index_soup = BeautifulSoup(index_page, 'html.parser')
+        index_page = self.get('{}/post?page=1&tags='.format(self.site_root)).text
+        index_soup = make_soup(index_page)
         # Find the page number of the last page
         return int(index_soup.findAll('a', href=True)[-10].text)
 
@@ -345,61 +1823,16 @@ class Konadl:
         of the image has to be included in the desired
         ratings.
         """
-        index_page = requests.get('{}/post?page=1&tags='.format(self.site_root), headers=self.headers).text
-        index_soup = BeautifulSoup(index_page, 'html.parser')
-        posts_list = index_soup.find('ul', {'id': 'post-list-posts'})
-        posts = posts_list.findAll('li')
-        for post in posts:
-            alt = post.find('img', alt=True)['alt']
-            rating = False
-            if 'Rating: Safe'in alt and self.safe:
-                rating = 'safe'
-            elif 'Rating: Questionable' in alt and self.questionable:
-                rating = 'questionable'
-            elif 'Rating: Explicit' in alt and self.explicit:
-                rating = 'explicit'
-            if rating:
-                return(post['id'])
-
-    def crawl_new_images(self):
-        """ Load all new images
-
-        Crawl the site and append all the new images
-        since the last download into download_queue
-        """
-        update_post_queue = Queue()
-        for page_num in range(1, self.get_total_pages() + 1):
-            update_post_queue.put(page_num)
-
-        while not update_post_queue.empty():
-            page = update_post_queue.get()
-            self.print_crawling_page(page)
-            page_source = requests.get('{}/post?page={}&tags='.format(self.site_root, page), headers=self.headers)
-            if page_source.status_code != requests.codes.ok:
-                if page_source.status_code == 429:
-                    self.print_429()
-                page_source.raise_for_status()
-            soup = BeautifulSoup(page_source.text, "html.parser")
-            # Find large image link and ratings
-            posts_list = soup.find('ul', {'id': 'post-list-posts'})
-            posts = posts_list.findAll('li')
-
-            for post in posts:
-                if post['id'] == self.previous_newest_id:
-                    return
-                alt = post.find('img', alt=True)['alt']
-                rating = False
-                if 'Rating: Safe'in alt and self.safe:
-                    rating = 'safe'
-                elif 'Rating: Questionable' in alt and self.questionable:
-                    rating = 'questionable'
-                elif 'Rating: Explicit' in alt and self.explicit:
-                    rating = 'explicit'
-                if rating:
-                    url = post.find('a', {'class': 'directlink'})['href']
-                    if 'https:' not in url:
-                        url = '{}{}'.format('https:', url)
-                    self.download_queue.put((url, page, rating))
+        tags = self.rating_tags()
+        if tags is None:
+            return None
+        # The JSON API returns a single post here, which is a lot
+        # cheaper to fetch and decode than the HTML index page
+        newest_posts = self.get('{}/post.json'.format(self.site_root), params={'limit': 1, 'tags': tags}).json()
+        if not newest_posts:
+            return None
+        # Same format as the id attribute of posts on index pages
+        return 'p{}'.format(newest_posts[0]['id'])
 
     def retrieve_post_image_worker(self):
         """ Get the large image url and download
@@ -407,136 +1840,392 @@ class Konadl:
         Crawls the post page, find the large image url(s)
         and calls the downloader to download all of them.
         """
+        import requests
 
-        # Always check if main thread wants to abort before getting a job
-        while not self.abort:
+        while not self.cancelled.is_set():
             try:
+                # Get a job from queue, exit once the queue is closed
+                post = self.download_queue.get()
+            except QueueClosed:
+                break
 
-                # Get a job from queue
-                url, page, rating = self.download_queue.get()
-
-                # Check if main thread wants to exit
-                if url is None:
-                    break
-
+            try:
                 # Start retrieving image
+                url, page = post.url, post.page
                 self.print_retrieval(url, page)
-                file_name = url.split("/")[-1].replace('%20', '_').replace('_-_', '_')
-                subfolder = ''
-
-                # Store into subdirectories if requested
-                if self.separate:
-                    subfolder = '{}/'.format(rating)
-                file_path = '{}{}{}'.format(self.storage, subfolder, file_name)
+                begin_time = time.time()
 
                 # Get image
-                image_request = requests.get(url, headers=self.headers)
+                image_request, content = self.download(url)
 
-                # Write image to file
-                with open(file_path, 'wb') as file:
-                    file_length = file.write(image_request.content)
-                    file.close()
+                # Warn user if 429 detected, the job is retried below
+                if image_request.status_code != requests.codes.ok:
+                    if image_request.status_code == 429:
+                        self.print_429()
+                        self.stats.count('http_429')
+                    raise requests.exceptions.HTTPError(
+                        'HTTP Error {}'.format(image_request.status_code), response=image_request)
 
-                # Check image integrity
-                if int(image_request.headers['content-length']) != file_length:
+                # Check that the whole image has been received
+                content_length = image_request.headers.get('content-length')
+                if content_length is not None and int(content_length) != len(content):
                     raise Exception('Faulty download')
 
-                # Put job back to queue if 429 detected and warn user
-                elif image_request.status_code != requests.codes.ok:
-                    if image_request.status_code == 429:
-                        self.print_429()
-                    self.download_queue.task_done()
-                    self.download_queue.put((url, page, rating))
-                    if os.path.isfile(file_path):
-                        os.remove(file_path)
-                    image_request.raise_for_status()
-                self.total_downloads += 1
-                self.download_queue.task_done()
-            except requests.exceptions.HTTPError:
-                self.write_traceback(page=page)
+                # Write image to storage and leave the rest to the verifiers,
+                # which mark the job as done once the image checks out
+                location = self.sink.write(post, content)
+                elapsed = time.time() - begin_time
+                self.stats.count('bytes', len(content))
+                self.stats.timed('download', elapsed)
+                self.verify_queue.put((post, location, content, elapsed))
+            except (Cancelled, QueueClosed):
+                # Keep the job so that it is saved with the progress
+                self.download_queue.put(post)
+                self.remove_image(post)
+            except Exception as e:
+                # Whatever happens while cleaning up, the job has to be
+                # put back or given up on, or the pipeline never drains
+                try:
+                    self.write_traceback(url=url, page=page)
+                    if not isinstance(e, requests.exceptions.HTTPError):
+                        self.print_exception()
+                    self.remove_image(post)
+                finally:
+                    self.retry_post(post, e)
+
+        # Print exit message when thread exits
+        self.print_thread_exit(str(threading.current_thread().name))
+
+    def remove_image(self, post):
+        # Removing a partial or faulty image is best effort, a
+        # failing sink must not take the worker thread down
+        try:
+            self.sink.remove(post)
+        except Exception:
+            self.write_traceback(url=post.url, page=post.page)
+
+    def start_verifiers(self):
+        # Create image verifier threads
+        self.verifier_threads = self.start_threads(
+            self.verify_post_image_worker, 'Verifier', self.verifier_threads_amount)
+
+    def requeue_unverified(self):
+        # Images which have not been verified yet have to
+        # be downloaded again when the progress is restored
+        while self.verify_queue.qsize():
+            self.download_queue.put(self.verify_queue.get()[0])
+
+    def image_valid(self, post, content):
+        """ Checks a downloaded image
+
+        Compares the image against the md5 in its URL and,
+        if self.verify_images is set, makes sure the image
+        is not truncated.
+        """
+        if self.verify and post.md5 is not None:
+            if hashlib.md5(content).hexdigest() != post.md5:
+                return False
+        if self.verify_images and image_truncated(content):
+            return False
+        return True
+
+    def record_checksum(self, md5, location):
+        # Checksums are kept in md5sum format so that
+        # the storage directory can also be checked with md5sum -c
+        with self.checksums_lock:
+            with open('{}checksums.md5'.format(self.storage), 'a') as checksums:
+                checksums.write('{}  {}\n'.format(md5, location))
+
+    def read_checksums(self):
+        # Returns the md5 of every verified image by location
+        checksums = {}
+        try:
+            with open('{}checksums.md5'.format(self.storage), 'r') as checksums_file:
+                for line in checksums_file:
+                    md5, _, key = line.rstrip('\n').partition('  ')
+                    checksums[key] = md5
+        except FileNotFoundError:
+            pass
+        return checksums
+
+    def verify_post_image_worker(self):
+        """ Verify downloaded images
+
+        Checks images handed over by the downloaders, so
+        hashing never holds up a download. Images that fail
+        the checks are removed and put back to download_queue.
+        """
+        while not self.cancelled.is_set():
+            try:
+                post, location, content, elapsed = self.verify_queue.get()
+            except QueueClosed:
+                break
+
+            try:
+                begin_time = time.time()
+                if self.image_valid(post, content):
+                    if self.verify and post.md5 is not None and isinstance(self.sink, FileSystemSink):
+                        self.record_checksum(post.md5, self.sink.key(post))
+                    self.stats.timed('verify', time.time() - begin_time)
+                    self.stats.count('images')
+                    self.total_downloads += 1
+                    if self.on_downloaded:
+                        self.on_downloaded(post, location, len(content), elapsed)
+                    self.tracker.done()
+                else:
+                    self.print_verification_failed(post)
+                    self.stats.count('verification_failures')
+                    self.remove_image(post)
+                    self.retry_post(post, Exception('Verification failed'))
             except Exception:
-                self.write_traceback(url=url, page=page)
-                self.print_exception()
-                self.download_queue.task_done()
-                self.download_queue.put((url, page, rating))
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
+                self.write_traceback(url=post.url, page=post.page)
+                self.tracker.done()
 
         # Print exit message when thread exits
         self.print_thread_exit(str(threading.current_thread().name))
 
+    def verify_storage(self):
+        """ Verify every image in the storage directory
+
+        Images listed in checksums.md5 are checked against
+        their md5, and every image is checked for truncation.
+        Returns the paths of the images that failed.
+        """
+        checksums = self.read_checksums()
+        scan_queue = Queue()
+        failed = []
+        failed_lock = threading.Lock()
+
+        def scan_worker():
+            while True:
+                try:
+                    key = scan_queue.get()
+                except QueueClosed:
+                    break
+                try:
+                    with open('{}{}'.format(self.storage, key), 'rb') as image:
+                        content = image.read()
+                except OSError:
+                    # Unreadable or vanished images fail as well
+                    content = None
+                md5 = checksums.get(key)
+                if content is None or (md5 is not None and hashlib.md5(content).hexdigest() != md5) \
+                        or image_truncated(content):
+                    with failed_lock:
+                        failed.append('{}{}'.format(self.storage, key))
+
+        threads = []
+        for identifier in range(self.verifier_threads_amount):
+            thread = threading.Thread(target=scan_worker)
+            thread.name = 'Verifier {}'.format(identifier)
+            thread.start()
+            threads.append(thread)
+
+        for directory, _, files in os.walk(self.storage):
+            for file in files:
+                if os.path.splitext(file)[1].lower() in ('.jpg', '.jpeg', '.png', '.gif'):
+                    scan_queue.put(os.path.relpath(os.path.join(directory, file), self.storage))
+        scan_queue.close()
+        for thread in threads:
+            thread.join()
+        return sorted(failed)
+
+    def follow_frontier(self, posts, page):
+        """ Keeps an update going until it reaches old posts
+
+        Drops posts that were already downloaded by the
+        previous run. Until a page with old posts is found,
+        every page queues the page one window further so that
+        as many pages as there are crawler threads are always
+        being fetched ahead.
+        """
+        new_posts = [post for post in posts if post.id > self.stop_id]
+        window = self.post_crawler_threads_amount
+        with self.frontier_lock:
+            if len(new_posts) < len(posts):
+                if self.frontier_page is None or page < self.frontier_page:
+                    self.frontier_page = page
+            next_page = page + window
+            if next_page <= self.last_page and (self.frontier_page is None or next_page < self.frontier_page):
+                self.tracker.add()
+                self.post_queue.put(next_page)
+        return new_posts
+
     def crawl_post_page_worker(self):
         """ Crawl the post list page and find posts
 
         Craws the posts index pages and record every post's
         URL before handing them to the image downloader.
         """
+        import requests
 
-        # Always check if main thread wants to abort before getting a job
-        while not self.abort:
+        while not self.cancelled.is_set():
             try:
-                # Get job from queue
+                # Get job from queue, exit once the queue is closed
                 page = self.post_queue.get()
-                if page is None:
-                    break
+            except QueueClosed:
+                break
 
+            try:
                 self.print_crawling_page(page)
+                begin_time = time.time()
 
                 # Get the page source
-                page_source = requests.get(
-                    '{}/post?page={}&tags='.format(self.site_root, page), headers=self.headers)
+                page_source = self.get_index_page(page)
 
-                # Put job back to queue if 429 received, and warn the user
+                # Warn the user if 429 received, the job is retried below
                 if page_source.status_code != requests.codes.ok:
                     if page_source.status_code == 429:
                         self.print_429()
-                    self.post_queue.task_done()
-                    self.post_queue.put(page)
-                    page_source.raise_for_status()
-
-                # Start parsing page
-                soup = BeautifulSoup(page_source.text, "html.parser")
-
-                # Find large image link and ratings
-                posts_list = soup.find('ul', {'id': 'post-list-posts'})
-                posts = posts_list.findAll('li')
-
-                # For every post, if its rating is what we want, add the
-                # post into the download_queue
+                        self.stats.count('http_429')
+                    raise requests.exceptions.HTTPError(
+                        'HTTP Error {}'.format(page_source.status_code), response=page_source)
+
+                posts = self.extract_posts(page_source.text, page)
+                if self.stop_id is not None:
+                    posts = self.follow_frontier(posts, page)
+                if self.skip_existing:
+                    posts = [post for post in posts if not self.already_downloaded(post)]
+
+                # Every post with a desired rating goes into download_queue
+                self.tracker.add(len(posts))
                 for post in posts:
-                    alt = post.find('img', alt=True)['alt']
-                    rating = False
-                    if 'Rating: Safe'in alt and self.safe:
-                        rating = 'safe'
-                    elif 'Rating: Questionable' in alt and self.questionable:
-                        rating = 'questionable'
-                    elif 'Rating: Explicit' in alt and self.explicit:
-                        rating = 'explicit'
-                    if rating:
-                        url = post.find('a', {'class': 'directlink'})['href']
-                        if 'https:' not in url:
-                            url = '{}{}'.format('https:', url)
-                        self.download_queue.put((url, page, rating))
-                self.post_queue.task_done()
-            except requests.exceptions.HTTPError:
+                    self.download_queue.put(post)
+                self.stats.count('pages')
+                self.stats.timed('crawl', time.time() - begin_time)
+                self.tracker.done()
+            except Exception as e:
                 self.write_traceback(page=page)
-            except Exception:
-                self.write_traceback(page=page)
-                self.print_exception()
-                self.post_queue.task_done()
-                self.post_queue.put(page)
+                if not isinstance(e, requests.exceptions.HTTPError):
+                    self.print_exception()
+                self.retry_page(page, e)
 
         # Print exit message when thread exits
         self.print_thread_exit(str(threading.current_thread().name))
 
+    def retry_post(self, post, error):
+        """ Puts a failed post back to download_queue
+
+        Posts that failed permanently (e.g. 404) or too many
+        times go to the dead letter file instead. Being rate
+        limited does not count as a failed attempt.
+        """
+        status = error_status(error)
+        if status != 429:
+            post.attempts += 1
+        if status in PERMANENT_STATUS_CODES or post.attempts >= self.max_attempts:
+            self.write_dead_letter({'id': post.id, 'url': post.url, 'page': post.page, 'rating': post.rating,
+                                    'variant': post.variant}, post.attempts, error)
+            self.tracker.done()
+        else:
+            self.stats.count('retries')
+            self.back_off(post.attempts, error)
+            self.download_queue.put(post)
+
+    def retry_page(self, page, error):
+        """ Puts a failed index page back to post_queue
+
+        Same as retry_post, attempts are counted here as
+        pages are queued as plain numbers.
+        """
+        status = error_status(error)
+        with self.attempts_lock:
+            attempts = self.page_attempts.get(page, 0) + (status != 429)
+            self.page_attempts[page] = attempts
+        if status in PERMANENT_STATUS_CODES or attempts >= self.max_attempts:
+            self.write_dead_letter({'page': page}, attempts, error)
+            if self.stop_id is not None:
+                # Keep the update going past the lost page
+                self.follow_frontier([], page)
+            self.tracker.done()
+        else:
+            self.stats.count('retries')
+            self.back_off(attempts, error)
+            self.post_queue.put(page)
+
+    def retry_delay(self, attempts, error):
+        """ Seconds to wait before a failed job is retried
+
+        The wait doubles with every failed attempt. When rate
+        limited, the server's Retry-After is honoured if it
+        gives a number of seconds, rate_limit_backoff otherwise.
+        """
+        if error_status(error) == 429:
+            retry_after = error.response.headers.get('retry-after', '')
+            delay = int(retry_after) if retry_after.isdigit() else self.rate_limit_backoff
+        else:
+            delay = self.retry_backoff * 2 ** max(attempts - 1, 0)
+        return min(delay, MAX_RETRY_BACKOFF)
+
+    def back_off(self, attempts, error):
+        # Waits before a retry, cut short if the run is cancelled
+        # so that the job is still queued when progress is saved
+        delay = self.retry_delay(attempts, error)
+        if delay > 0:
+            self.cancelled.wait(delay)
+
+    def write_dead_letter(self, job, attempts, error):
+        """ Records a job that is given up on
+
+        dead_letter.jsonl in the storage directory gets one
+        JSON record per job, see retry_dead_letter().
+        """
+        job['attempts'] = attempts
+        job['error'] = '{}: {}'.format(type(error).__name__, error)
+        job['time'] = str(datetime.datetime.now())
+        self.stats.count('dead_letters')
+        self.print_dead_letter(job)
+        with self.dead_letter_lock:
+            with open('{}dead_letter.jsonl'.format(self.storage), 'a') as dead_letterf:
+                dead_letterf.write(json.dumps(job) + '\n')
+
+    def read_dead_letter(self):
+        # Returns the jobs in the dead letter file
+        return read_history('{}dead_letter.jsonl'.format(self.storage))
+
+    def retry_dead_letter(self):
+        """ Retries the jobs in the dead letter file
+
+        The file is emptied and its jobs go through the
+        pipeline once more with fresh attempt counters. Jobs
+        failing again end up in the file again. Settings are
+        taken from the metadata file, as with update().
+        """
+        self.process_crawling_options()
+        if self.metadata_present():
+            self.read_metadata()
+        self.current_newest_id = self.previous_newest_id
+        self.stop_id = None
+        jobs = self.read_dead_letter()
+        if not jobs:
+            return False
+
+        self.error_logs_file = '{}errors.log'.format(self.storage)
+        self.prepare_sink()
+        copyreg.pickle(Queue, pickle_queue, unpickle_queue)
+        self.post_queue = Queue()
+        self.download_queue = PostQueue()
+        self.prepare_pipeline()
+
+        # Jobs that are still queued when paused are kept
+        # with the progress files instead
+        os.remove('{}dead_letter.jsonl'.format(self.storage))
+        self.tracker.add(len(jobs))
+        for job in jobs:
+            if 'url' in job:
+                self.download_queue.put(Post(job['id'], job['url'], job['page'], job['rating'], job['variant']))
+            else:
+                self.post_queue.put(job['page'])
+        return self.run_pipeline()
+
     def progress_files_present(self):
         # Determines if the progress files are present
-        self.progress_files = ['{}download_queue.pkl'.format(self.storage),
+        # download_queue.pkl is left by versions before PostQueue
+        self.progress_files = ['{}download_queue.bin'.format(self.storage),
+                               '{}download_queue.pkl'.format(self.storage),
                                '{}post_queue.pkl'.format(self.storage)]
-        for file in self.progress_files:
-            if not os.path.isfile(file):
-                return False
-        return True
+        download_queue_present = os.path.isfile(self.progress_files[0]) or os.path.isfile(self.progress_files[1])
+        return download_queue_present and os.path.isfile(self.progress_files[2])
 
     def remove_progress_files(self):
         # Remove progress files
@@ -581,10 +2270,40 @@ class Konadl:
         metadata['UPDATING'] = {}
         metadata['UPDATING']['previous_newest_id'] = self.current_newest_id
         metadata['UPDATING']['SEPARATE'] = self.separate
+        metadata['UPDATING']['LAYOUT'] = self.layout
+        metadata['UPDATING']['VARIANT'] = self.variant
+        metadata['UPDATING']['MAX_IMAGE_SIZE'] = self.max_image_size
+        # A paused update has to resume where it stopped
+        if not self.job_done and self.stop_id is not None:
+            metadata['UPDATING']['STOP_ID'] = self.stop_id
+            metadata['UPDATING']['LAST_PAGE'] = self.last_page
 
         with open('{}metadata.json'.format(self.storage), 'w') as progressf:
             json.dump(metadata, progressf, indent=2)
 
+    def append_history(self, status, mode=None):
+        """ Appends a record of the run to the history file
+
+        history.jsonl in the storage directory gets one JSON
+        record per run, which is kept when the metadata is
+        reset, so that the throughput of runs can be compared.
+        """
+        if mode is None:
+            mode = 'update' if self.stop_id is not None else 'crawl'
+        record = self.stats.record(
+            status=status,
+            mode=mode,
+            resumed=bool(self.load_progress),
+            site=self.site_root,
+            version=self.VERSION,
+            variant=self.variant,
+            threads={'crawlers': self.post_crawler_threads_amount,
+                     'downloaders': self.downloader_threads_amount,
+                     'verifiers': self.verifier_threads_amount},
+            bandwidth_limit=self.bandwidth_limit)
+        with open('{}history.jsonl'.format(self.storage), 'a') as historyf:
+            historyf.write(json.dumps(record) + '\n')
+
     def read_metadata(self):
         with open('{}metadata.json'.format(self.storage), 'r') as progressf:
             metadata = json.load(progressf)
@@ -596,6 +2315,11 @@ class Konadl:
         self.time_elapsed = metadata['STATISTICS']['time_elapsed']
         self.previous_newest_id = metadata['UPDATING']['previous_newest_id']
         self.separate = metadata['UPDATING']['SEPARATE']
+        self.layout = metadata['UPDATING'].get('LAYOUT', 'flat')
+        self.variant = metadata['UPDATING'].get('VARIANT', 'original')
+        self.max_image_size = metadata['UPDATING'].get('MAX_IMAGE_SIZE', 0)
+        self.stop_id = metadata['UPDATING'].get('STOP_ID')
+        self.last_page = metadata['UPDATING'].get('LAST_PAGE', False)
 
     def save_queues(self):
         """ Saves the queues to files
@@ -605,10 +2329,15 @@ class Konadl:
         into the progress files.
         """
 
-        # Serialize download queue and dump to file
-        with open('{}download_queue.pkl'.format(self.storage), 'wb') as download_progress:
-            pickle.dump(self.download_queue, download_progress)
-            download_progress.close()
+        import pickle
+
+        # Dump download queue in its compact binary format
+        with open('{}download_queue.bin'.format(self.storage), 'wb') as download_progress:
+            self.download_queue.save(download_progress)
+        try:
+            os.remove('{}download_queue.pkl'.format(self.storage))
+        except FileNotFoundError:
+            pass
 
         # Serialize post queue and dump to file
         with open('{}post_queue.pkl'.format(self.storage), 'wb') as post_progress:
@@ -622,13 +2351,18 @@ class Konadl:
         the configuration file contents.
         """
 
+        import pickle
+
         self.print_loading_progress()
 
         try:
-            # Deserialize and load download queue
-            with open('{}download_queue.pkl'.format(self.storage), 'rb') as download_progress:
-                self.download_queue = pickle.load(download_progress)
-                download_progress.close()
+            # Load download queue, or the pickled queue of older versions
+            if os.path.isfile('{}download_queue.bin'.format(self.storage)):
+                with open('{}download_queue.bin'.format(self.storage), 'rb') as download_progress:
+                    self.download_queue = PostQueue.load(download_progress)
+            else:
+                with open('{}download_queue.pkl'.format(self.storage), 'rb') as download_progress:
+                    self.download_queue = self.convert_download_queue(pickle.load(download_progress))
 
             # Deserialize and load post queue
             with open('{}post_queue.pkl'.format(self.storage), 'rb') as post_progress:
@@ -637,9 +2371,30 @@ class Konadl:
 
             # Read metadata
             self.read_metadata()
-        except (KeyError, ValueError):
+        except (KeyError, ValueError, EOFError, OverflowError, struct.error) as e:
             self.print_faulty_progress_file()
-            exit(1)
+            raise FaultyProgressFile('Faulty progress file in {}'.format(self.storage)) from e
+
+    def convert_download_queue(self, queue):
+        """ Converts a pickled download queue into a PostQueue
+
+        Older versions queued Post objects without some of
+        today's fields, or (url, page, rating) tuples in
+        which case the post id is taken from the file name.
+        """
+        download_queue = PostQueue()
+        for item in list(queue.queue):
+            if isinstance(item, Post):
+                post = Post(item.id, item.url, item.page, item.rating, getattr(item, 'variant', 'original'),
+                            getattr(item, 'attempts', 0))
+            else:
+                url, page, rating = item
+                if url is None:
+                    continue  # Exit signal of old worker threads
+                post_id = LEGACY_ID_PATTERN.search(url.split('/')[-1])
+                post = Post(int(post_id.group(1)) if post_id else 0, url, page, rating)
+            download_queue.put(post)
+        return download_queue
 
     @print_locker
     def warn_keyboard_interrupt(self):
@@ -689,6 +2444,18 @@ class Konadl:
         print('Trying to recover from error', file=sys.stderr)
         print('Putting job back to queue', file=sys.stderr)
 
+    @print_locker
+    def print_verification_failed(self, post):
+        # Downloaded image did not pass verification
+        print('Verification failed: {}'.format(post.url), file=sys.stderr)
+        print('Putting job back to queue', file=sys.stderr)
+
+    @print_locker
+    def print_dead_letter(self, job):
+        # Job is given up on and written to the dead letter file
+        print('Giving up after {} attempt(s): {}'.format(job['attempts'], job.get('url', job['page'])), file=sys.stderr)
+        print('Error: {}'.format(job['error']), file=sys.stderr)
+
     @print_locker
     def print_faulty_progress_file(self):
         # Tell the use the progress file is faulty
@@ -696,6 +2463,193 @@ class Konadl:
         print('Aborting\n', file=sys.stderr)
 
 
+class Batch:
+    """ Runs the crawls listed in a job file
+
+    A job file (JSON, or YAML if PyYAML is installed) lists
+    targets, each one with its own storage directory, site,
+    ratings and limits. All targets run in one process and
+    share one connection pool, one budget of concurrent
+    requests and optionally one global download rate.
+
+    Nothing is ever asked: storage directories are created,
+    saved progress is resumed and progress files of finished
+    targets are removed.
+    """
+
+    def __init__(self, config, konadl_class=Konadl):
+        self.config = config
+        self.konadl_class = konadl_class
+        self.targets = config['targets']
+        self.concurrency = config.get('concurrency', 2)  # Targets running at the same time
+        self.connections = config.get('connections', 30)  # Requests in flight across all targets
+        self.limiter = RateLimiter(parse_size(config.get('limit_rate', 0)))
+        self.request_slots = threading.BoundedSemaphore(self.connections)
+        self.target_slots = threading.BoundedSemaphore(self.concurrency)
+        self.session = None
+        self.running = []
+        self.running_lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.results = []
+
+    @classmethod
+    def load(cls, path, konadl_class=Konadl):
+        with open(path, 'r') as jobf:
+            if path.endswith(('.yml', '.yaml')):
+                try:
+                    import yaml
+                except ImportError:
+                    raise ImportError('PyYAML is required to read YAML job files, '
+                                      'install it with "pip install pyyaml"') from None
+                config = yaml.safe_load(jobf)
+            else:
+                config = json.load(jobf)
+        return cls(config, konadl_class)
+
+    def make_konadl(self, target):
+        """ Creates a Konadl object for a target
+
+        Keys missing from the target keep the defaults
+        of Konadl.
+        """
+        kona = self.konadl_class()
+        kona.storage = os.path.join(target['storage'], '')
+        kona.yandere = target.get('site', 'konachan') == 'yandere'
+        ratings = target.get('ratings', ['safe'])
+        kona.safe = 'safe' in ratings
+        kona.questionable = 'questionable' in ratings
+        kona.explicit = 'explicit' in ratings
+        kona.separate = target.get('separate', kona.separate)
+        kona.layout = target.get('layout', kona.layout)
+        kona.variant = target.get('variant', kona.variant)
+        kona.max_image_size = parse_size(target.get('max_size', 0))
+        if kona.variant == 'largest' and not kona.max_image_size:
+            raise ValueError('max_size is required with the largest variant')
+        kona.post_crawler_threads_amount = target.get('crawlers', kona.post_crawler_threads_amount)
+        kona.downloader_threads_amount = target.get('downloaders', kona.downloader_threads_amount)
+        kona.verifier_threads_amount = target.get('verifiers', kona.verifier_threads_amount)
+        kona.verify_images = target.get('verify_images', kona.verify_images)
+        kona.io_policy = target.get('io_policy', kona.io_policy)
+        kona.max_attempts = target.get('max_attempts', kona.max_attempts)
+        kona.retry_backoff = target.get('retry_backoff', kona.retry_backoff)
+        kona.bandwidth_limit = parse_size(target.get('limit_rate', 0))
+        for host, rate in target.get('host_limits', {}).items():
+            kona.host_bandwidth_limits[host] = parse_size(rate)
+        for window in target.get('schedule', []):
+            kona.bandwidth_schedule.append(parse_schedule_window(window))
+        if 's3' in target:
+            kona.sink = S3Sink.from_environment(target['s3']['endpoint'], target['s3']['bucket'],
+                                                target['s3'].get('region', 'us-east-1'),
+                                                separate=kona.separate, layout=LAYOUTS[kona.layout]())
+
+        # Everything goes through the batch's session and budgets
+        kona.session = self.session
+        kona.request_slots = self.request_slots
+        kona.shared_bandwidth_limiter = self.limiter
+        return kona
+
+    def run_target(self, target, result, finished):
+        try:
+            self.run_target_in_slot(target, result)
+        finally:
+            finished.set()
+
+    def run_target_in_slot(self, target, result):
+        with self.target_slots:
+            if self.cancelled.is_set():
+                result['status'] = 'skipped'
+                return
+            begin_time = time.time()
+            try:
+                kona = self.make_konadl(target)
+                downloads = [0]
+                on_downloaded = kona.on_downloaded
+
+                def count_download(*args):
+                    downloads[0] += 1
+                    if on_downloaded:
+                        on_downloaded(*args)
+                kona.on_downloaded = count_download
+
+                if not os.path.isdir(kona.storage):
+                    os.makedirs(kona.storage)
+                with self.running_lock:
+                    self.running.append(kona)
+                    if self.cancelled.is_set():
+                        kona.cancel()  # Pauses the target as soon as it starts
+
+                if kona.progress_files_present():
+                    kona.load_progress = True
+                    done = kona.crawl()
+                elif target.get('update') and kona.metadata_present():
+                    # Targets without metadata yet are crawled first
+                    done = kona.update()
+                    if kona.current_newest_id == kona.previous_newest_id:
+                        done = None  # Nothing new to download
+                elif target.get('all'):
+                    done = kona.crawl_all_pages()
+                else:
+                    kona.pages = target.get('pages', 1)
+                    done = kona.crawl()
+
+                if done is None:
+                    result['status'] = 'up to date'
+                elif done:
+                    result['status'] = 'done'
+                    if kona.progress_files_present():
+                        kona.remove_progress_files()
+                else:
+                    result['status'] = 'paused'
+                result['downloads'] = downloads[0]
+            except Exception as e:
+                result['status'] = 'failed'
+                result['error'] = '{}: {}'.format(type(e).__name__, e)
+            result['time_elapsed'] = round(time.time() - begin_time, 5)
+
+    def run(self):
+        """ Runs every target
+
+        Returns a list of results, one per target and in
+        the order of the job file. Ctrl+C pauses all running
+        targets so that they resume on the next run.
+        """
+        if self.session is None:
+            self.session = make_session(Konadl().headers, self.connections)
+        self.results = []
+        finished = []
+        for number, target in enumerate(self.targets):
+            result = {'name': target.get('name', target['storage']), 'storage': target['storage'],
+                      'status': 'pending', 'downloads': 0, 'time_elapsed': 0, 'error': None}
+            self.results.append(result)
+            finished.append(threading.Event())
+            thread = threading.Thread(target=self.run_target, args=(target, result, finished[-1]))
+            thread.name = 'Target {}'.format(number)
+            thread.start()
+
+        # Events rather than Thread.join, as an interrupted
+        # join may leave the thread looking stopped
+        try:
+            for event in finished:
+                while not event.wait(0.5):
+                    pass
+        except KeyboardInterrupt:
+            self.cancel()
+            for event in finished:
+                while not event.wait(0.5):
+                    pass
+        return self.results
+
+    def cancel(self):
+        self.cancelled.set()
+        with self.running_lock:
+            for kona in self.running:
+                kona.cancel()
+
+    def save_results(self, path):
+        with open(path, 'w') as resultsf:
+            json.dump(self.results, resultsf, indent=2)
+
+
 if __name__ == '__main__':
     """ Sample crawling
 
@@ -0,0 +1,82 @@
+import os
+import sys
+
+import pytest
+
+# libkonadl is a plain module in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from libkonadl import Konadl  # noqa: E402
+
+
+class QuietKonadl(Konadl):
+    """ Konadl that keeps its progress messages to itself
+
+    print_exception is left alone, so that errors in
+    worker threads still show up in the test output.
+    Failed jobs are retried without backing off.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.retry_backoff = 0
+        self.rate_limit_backoff = 0
+
+    def warn_keyboard_interrupt(self):
+        pass
+
+    def print_saving_progress(self):
+        pass
+
+    def print_loading_progress(self):
+        pass
+
+    def print_retrieval(self, url, page):
+        pass
+
+    def print_crawling_page(self, page):
+        pass
+
+    def print_thread_exit(self, name):
+        pass
+
+    def print_429(self):
+        pass
+
+    def print_verification_failed(self, post):
+        pass
+
+    def print_dead_letter(self, job):
+        pass
+
+    def print_faulty_progress_file(self):
+        pass
+
+
+@pytest.fixture
+def konadl_class():
+    return QuietKonadl
+
+
+@pytest.fixture
+def make_konadl(tmp_path):
+    """ Returns a factory of quiet Konadl objects
+
+    Every object downloads all ratings with two crawler and
+    two downloader threads into a storage directory below
+    tmp_path, named name if given. Any other attribute can
+    be set through keyword arguments.
+    """
+
+    def make(name=None, **attributes):
+        storage = tmp_path / name if name else tmp_path
+        storage.mkdir(exist_ok=True)
+        kona = QuietKonadl()
+        kona.storage = '{}/'.format(storage)
+        kona.safe = kona.questionable = kona.explicit = True
+        kona.post_crawler_threads_amount = 2
+        kona.downloader_threads_amount = 2
+        for attribute, value in attributes.items():
+            setattr(kona, attribute, value)
+        return kona
+
+    return make
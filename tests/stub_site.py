@@ -0,0 +1,97 @@
+""" A moebooru site answering Konadl.get() without a network
+"""
+import datetime
+import hashlib
+import json
+import time
+import urllib.parse
+
+RATINGS = ('Safe', 'Questionable', 'Explicit')
+
+
+def image(post_id):
+    return b'\xff\xd8\xff\xe0' + bytes([post_id % 256]) * (100 + post_id) + b'\xff\xd9'
+
+
+def image_url(post_id):
+    return '//konachan.com/image/{}/Konachan.com%20-%20{}%20tag.jpg'.format(
+        hashlib.md5(image(post_id)).hexdigest(), post_id)
+
+
+def post_item(post_id):
+    # One post of the post list as rendered by moebooru
+    return ('<li style="width: 160px;" id="p{0}" class="creator-id-1"><div class="inner">'
+            '<a class="thumb" href="/post/show/{0}"><img src="https://konachan.com/data/preview/{0}.jpg" '
+            'alt="Rating: {1} Score: 1 Tags: tag User: x" class="preview" width="150"></a></div>'
+            '<a class="directlink largeimg" href="{2}"><span class="directlink-info">1x1</span></a></li>').format(
+                post_id, RATINGS[post_id % 3], image_url(post_id))
+
+
+def index_page(items, scripts='', pages=1):
+    # The number of pages is read from the last paginator link,
+    # which is followed by 9 other links on moebooru sites
+    paginator = ''.join('<a href="/post?page={0}">{0}</a>'.format(page) for page in range(1, pages + 1))
+    footer = ''.join('<a href="/footer/{}">x</a>'.format(number) for number in range(9))
+    return ('<html><body><ul id="post-list-posts">{}</ul><div id="paginator">{}</div>{}'
+            '<script type="text/javascript">\n{}\n</script></body></html>').format(
+                ''.join(items), paginator, footer, scripts)
+
+
+class StubResponse:
+
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers if headers is not None else {'content-length': str(len(content))}
+        self.encoding = 'utf-8'
+        self.elapsed = datetime.timedelta(0)
+
+    @property
+    def text(self):
+        return self.content.decode()
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1):
+        for offset in range(0, len(self.content), chunk_size):
+            yield self.content[offset:offset + chunk_size]
+
+    def close(self):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.HTTPError('HTTP Error {}'.format(self.status_code), response=self)
+
+
+class StubSite:
+    """ Serves posts total..1, per_page of them per page
+
+    Every request takes delay seconds. Requests are
+    counted by path in self.requests.
+    """
+
+    def __init__(self, total=23, per_page=5, delay=0):
+        self.total = total
+        self.per_page = per_page
+        self.delay = delay
+        self.requests = {}
+
+    def get(self, url, params=None, **kwargs):
+        time.sleep(self.delay)
+        url = urllib.parse.urlparse(url)
+        self.requests[url.path] = self.requests.get(url.path, 0) + 1
+        if url.path == '/post.json':
+            return StubResponse(200, json.dumps([{'id': self.total}]).encode())
+        if url.path == '/post':
+            page = int(urllib.parse.parse_qs(url.query)['page'][0])
+            first = self.total - (page - 1) * self.per_page
+            post_ids = range(first, max(first - self.per_page, 0), -1)
+            pages = -(-self.total // self.per_page)
+            return StubResponse(200, index_page([post_item(post_id) for post_id in post_ids], pages=pages).encode())
+        if url.path.startswith('/image/'):
+            post_id = int(urllib.parse.unquote(url.path).split(' ')[2])
+            return StubResponse(200, image(post_id))
+        return StubResponse(404, b'')
@@ -0,0 +1,127 @@
+import datetime
+import time
+
+import pytest
+
+import libkonadl
+from libkonadl import RateLimiter, parse_schedule_window, parse_size
+
+
+class FakeClock:
+    # time.monotonic and time.sleep, advanced by sleeping only
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(time, 'sleep', clock.sleep)
+    return clock
+
+
+@pytest.fixture
+def set_time(monkeypatch):
+    # Sets the wall clock time of day seen by libkonadl
+
+    def set_time(hour, minute):
+        class FixedDatetime(datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return cls(2024, 1, 1, hour, minute)
+        monkeypatch.setattr(libkonadl.datetime, 'datetime', FixedDatetime)
+
+    return set_time
+
+
+@pytest.mark.parametrize('size, expected', [
+    ('512', 512), (2048, 2048), ('512K', 524288), ('1.5M', 1572864), ('2g', 2147483648),
+    ('1T', 1099511627776), (' 64 KB ', 65536), ('0', 0),
+])
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
+def test_parse_size_rejects_garbage():
+    with pytest.raises(ValueError):
+        parse_size('fast')
+
+
+def test_parse_schedule_window():
+    assert parse_schedule_window('09:00-18:00=512K') == ('09:00', '18:00', 524288)
+    assert parse_schedule_window(' 9:30 - 6:00 =0') == ('09:30', '06:00', 0)
+    with pytest.raises(ValueError):
+        parse_schedule_window('09:00=1M')
+
+
+def test_rate_limiter(clock):
+    limiter = RateLimiter(1000)
+    # Nothing has been saved up yet, so every byte has to wait
+    limiter.consume(500)
+    assert clock.sleeps == [0.5]
+    limiter.consume(1000)
+    assert clock.sleeps == [0.5, 1.0]
+
+    # Idle time allows a burst of at most one second of data
+    clock.now += 10
+    limiter.consume(1000)
+    assert len(clock.sleeps) == 2
+    limiter.consume(250)
+    assert clock.sleeps[2] == pytest.approx(0.25)
+
+
+def test_rate_limiter_unlimited(clock):
+    limiter = RateLimiter()
+    limiter.consume(10 ** 9)
+    limiter.rate = 100
+    limiter.consume(100)
+    assert clock.sleeps == [1.0]
+    limiter.rate = 0
+    limiter.consume(10 ** 9)
+    assert clock.sleeps == [1.0]
+
+
+@pytest.mark.parametrize('hour, minute, expected', [
+    (8, 59, 100), (9, 0, 10), (17, 59, 10), (18, 0, 100),
+    (21, 59, 100), (22, 0, 0), (23, 59, 0), (0, 0, 0), (5, 59, 0), (6, 0, 100),
+])
+def test_current_bandwidth_limit(set_time, hour, minute, expected):
+    kona = libkonadl.Konadl()
+    kona.bandwidth_limit = 100
+    # The second window wraps around midnight
+    kona.bandwidth_schedule = [('09:00', '18:00', 10), ('22:00', '06:00', 0)]
+    set_time(hour, minute)
+    assert kona.current_bandwidth_limit() == expected
+
+
+def test_throttle(clock, set_time):
+    kona = libkonadl.Konadl()
+    kona.bandwidth_limit = 1000
+    kona.host_bandwidth_limits = {'files.yande.re': 100}
+    set_time(12, 0)
+
+    kona.throttle('https://konachan.com/post?page=1', 500)
+    assert clock.sleeps == [0.5]
+    # Slowed down by both the global and the host limit
+    kona.throttle('https://files.yande.re/image/a.jpg', 100)
+    assert clock.sleeps == [0.5, 0.1, 1.0]
+    assert list(kona.host_bandwidth_limiters) == ['files.yande.re']
+
+    # The schedule overrides the global limit as time goes by
+    kona.bandwidth_schedule = [('12:00', '13:00', 0)]
+    kona.throttle('https://konachan.com/post?page=2', 10 ** 6)
+    assert clock.sleeps == [0.5, 0.1, 1.0]
+    set_time(13, 0)
+    kona.throttle('https://konachan.com/post?page=3', 2000)
+    assert kona.bandwidth_limiter.rate == 1000
+    assert clock.sleeps[3] == pytest.approx(1.0)
@@ -0,0 +1,93 @@
+import json
+import sys
+
+import pytest
+
+from libkonadl import Batch
+from stub_site import StubSite
+
+
+def make_batch(tmp_path, konadl_class, site):
+    config = {'concurrency': 2, 'connections': 4, 'targets': [
+        {'name': 'all', 'storage': str(tmp_path / 'all'), 'ratings': ['safe', 'questionable', 'explicit'],
+         'pages': 2, 'crawlers': 2, 'downloaders': 2},
+        {'name': 'safe', 'storage': str(tmp_path / 'safe'), 'ratings': ['safe'], 'pages': 1, 'layout': 'hash'},
+    ]}
+    batch = Batch(config, konadl_class)
+    batch.session = site
+    return batch
+
+
+def test_batch(tmp_path, konadl_class):
+    batch = make_batch(tmp_path, konadl_class, StubSite())
+    results = batch.run()
+    assert [(result['name'], result['status'], result['downloads']) for result in results] == [
+        ('all', 'done', 10), ('safe', 'done', 1)]
+
+    batch.save_results(str(tmp_path / 'results.json'))
+    with open(str(tmp_path / 'results.json')) as resultsf:
+        assert json.load(resultsf) == results
+
+
+def test_cancel_before_targets_start(tmp_path, konadl_class):
+    batch = make_batch(tmp_path, konadl_class, StubSite())
+    batch.cancel()
+    assert [result['status'] for result in batch.run()] == ['skipped', 'skipped']
+
+
+def test_cancelled_target_pauses_at_once(make_konadl):
+    kona = make_konadl(session=StubSite(), pages=3)
+    kona.cancel()  # Before the crawl has even started
+    assert kona.crawl() is False
+    assert kona.session.requests == {'/post.json': 1}
+    assert kona.progress_files_present()
+
+    # The saved progress resumes in a fresh run
+    kona = make_konadl(session=StubSite(), load_progress=True)
+    assert kona.crawl() is True
+    assert kona.total_downloads == 15
+
+
+def test_faulty_progress_fails_the_target(tmp_path, konadl_class):
+    batch = make_batch(tmp_path, konadl_class, StubSite())
+    (tmp_path / 'all').mkdir()
+    (tmp_path / 'all' / 'download_queue.bin').write_bytes(b'garbage')
+    (tmp_path / 'all' / 'post_queue.pkl').write_bytes(b'garbage')
+    results = batch.run()
+    assert results[0]['status'] == 'failed'
+    assert results[0]['error'].startswith('FaultyProgressFile')
+    assert results[1]['status'] == 'done'
+
+
+def test_largest_variant_needs_max_size(tmp_path, konadl_class):
+    config = {'targets': [{'name': 'largest', 'storage': str(tmp_path / 'largest'), 'variant': 'largest'}]}
+    batch = Batch(config, konadl_class)
+    batch.session = StubSite()
+    results = batch.run()
+    assert results[0]['status'] == 'failed'
+    assert results[0]['error'].startswith('ValueError')
+    assert batch.session.requests == {}
+
+
+def test_downloads_are_counted_alongside_on_downloaded(tmp_path, konadl_class):
+    downloaded = []
+
+    class RecordingKonadl(konadl_class):
+
+        def __init__(self):
+            super().__init__()
+            self.on_downloaded = lambda post, *args: downloaded.append(post.id)
+
+    config = {'targets': [{'name': 'safe', 'storage': str(tmp_path / 'safe'), 'ratings': ['safe'], 'pages': 1}]}
+    batch = Batch(config, RecordingKonadl)
+    batch.session = StubSite()
+    results = batch.run()
+    assert results[0]['downloads'] == 1
+    assert len(downloaded) == 1
+
+
+def test_yaml_job_file_needs_pyyaml(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'yaml', None)
+    (tmp_path / 'job.yml').write_text('targets: []\n')
+    with pytest.raises(ImportError, match='PyYAML'):
+        Batch.load(str(tmp_path / 'job.yml'))
@@ -0,0 +1,128 @@
+import json
+
+import pytest
+
+from libkonadl import Konadl
+from stub_site import image_url, index_page, post_item
+
+MD5 = '0123456789abcdef0123456789abcdef'
+
+
+def make_konadl(ratings=('safe', 'questionable', 'explicit'), variant='original'):
+    kona = Konadl()
+    kona.safe = 'safe' in ratings
+    kona.questionable = 'questionable' in ratings
+    kona.explicit = 'explicit' in ratings
+    kona.variant = variant
+    return kona
+
+
+def summary(posts):
+    return [(post.id, post.url, post.page, post.rating, post.variant) for post in posts]
+
+
+def test_moebooru_page():
+    page = index_page([post_item(post_id) for post_id in (6, 5, 4)])
+    assert summary(make_konadl().extract_posts(page, 2)) == [
+        (6, 'https:' + image_url(6), 2, 'safe', 'original'),
+        (5, 'https:' + image_url(5), 2, 'explicit', 'original'),
+        (4, 'https:' + image_url(4), 2, 'questionable', 'original'),
+    ]
+
+
+def test_attribute_order():
+    item = ('<li class="creator-id-1" id="p10"><div class="inner"><a href="/post/show/10" class="thumb">'
+            '<img class="preview" alt="Rating: Safe Score: 3" src="/preview.jpg"></a></div>'
+            '<a href="https://files.yande.re/image/{}/yande.re%2010.png" class="largeimg directlink">'
+            '1x1</a></li>').format(MD5)
+    posts = make_konadl().extract_posts(index_page([item]), 1)
+    assert summary(posts) == [(10, 'https://files.yande.re/image/{}/yande.re%2010.png'.format(MD5), 1, 'safe', 'original')]
+    assert posts[0].md5 == MD5
+
+
+@pytest.mark.parametrize('href, url', [
+    ('//konachan.com/image/{}/a.jpg'.format(MD5), 'https://konachan.com/image/{}/a.jpg'.format(MD5)),
+    ('http://konachan.net/image/{}/a.jpg'.format(MD5), 'http://konachan.net/image/{}/a.jpg'.format(MD5)),
+    ('https://konachan.com/image/{}/a.jpg'.format(MD5), 'https://konachan.com/image/{}/a.jpg'.format(MD5)),
+])
+def test_link_schemes(href, url):
+    item = ('<li id="p1"><img alt="Rating: Safe" src="/p.jpg">'
+            '<a class="directlink largeimg" href="{}">1x1</a></li>').format(href)
+    assert [post.url for post in make_konadl().extract_posts(index_page([item]), 1)] == [url]
+
+
+@pytest.mark.parametrize('ratings, post_ids', [
+    (('safe',), [6, 3]),
+    (('questionable',), [4, 1]),
+    (('explicit',), [5, 2]),
+    (('safe', 'explicit'), [6, 5, 3, 2]),
+    ((), []),
+])
+def test_rating_filter(ratings, post_ids):
+    page = index_page([post_item(post_id) for post_id in range(6, 0, -1)])
+    assert [post.id for post in make_konadl(ratings).extract_posts(page, 1)] == post_ids
+
+
+def test_incomplete_posts_do_not_match_across_items():
+    no_alt = '<li id="p9"><img src="/p.jpg"><a class="directlink" href="//h/image/{}/9.jpg">x</a></li>'.format(MD5)
+    no_link = '<li id="p8"><img alt="Rating: Explicit" src="/p.jpg"><a class="thumb" href="/post/show/8">x</a></li>'
+    page = index_page([no_alt, no_link, post_item(7), no_link.replace('p8', 'p6')])
+    posts = make_konadl().extract_posts(page, 1)
+    assert summary(posts) == [(7, 'https:' + image_url(7), 1, 'questionable', 'original')]
+
+
+def register_data(post_id):
+    return {'id': post_id, 'rating': 's', 'file_url': 'https://h/image/{}/{}.png'.format(MD5, post_id),
+            'file_size': 9000000, 'jpeg_url': 'https://h/jpeg/{}/{}.jpg'.format(MD5, post_id),
+            'jpeg_file_size': 3000000, 'sample_url': 'https://h/sample/{}/{}.jpg'.format(MD5, post_id),
+            'sample_file_size': 500000, 'preview_url': 'https://h/data/preview/{}.jpg'.format(post_id)}
+
+
+def test_register_resp_data():
+    scripts = 'Post.register_resp({});'.format(json.dumps({'posts': [register_data(3), register_data(6)], 'tags': {}}))
+    page = index_page([post_item(post_id) for post_id in (6, 3)], scripts)
+
+    posts = make_konadl(variant='jpeg').extract_posts(page, 1)
+    assert summary(posts) == [(6, 'https://h/jpeg/{}/6.jpg'.format(MD5), 1, 'safe', 'jpeg'),
+                              (3, 'https://h/jpeg/{}/3.jpg'.format(MD5), 1, 'safe', 'jpeg')]
+    assert posts[0].md5 is None  # Not the md5 of this variant
+
+    kona = make_konadl(variant='largest')
+    kona.max_image_size = 1000000
+    assert [post.variant for post in kona.extract_posts(page, 1)] == ['sample', 'sample']
+
+
+def test_register_calls():
+    scripts = '\n'.join('Post.register({})'.format(json.dumps(register_data(post_id))) for post_id in (6, 3))
+    page = index_page([post_item(post_id) for post_id in (6, 3)], scripts)
+    assert [post.url for post in make_konadl(variant='sample').extract_posts(page, 1)] == [
+        'https://h/sample/{}/6.jpg'.format(MD5), 'https://h/sample/{}/3.jpg'.format(MD5)]
+
+
+
+def test_largest_never_guesses_the_size():
+    # Post 9 has data without a preview URL, post 3 has no data at all
+    data = register_data(9)
+    del data['preview_url']
+    data['sample_file_size'] = 2000000
+    scripts = 'Post.register_resp({});'.format(json.dumps({'posts': [data, register_data(6)]}))
+    page = index_page([post_item(post_id) for post_id in (9, 6, 3)], scripts)
+
+    kona = make_konadl(variant='largest')
+    kona.max_image_size = 1000000
+    assert [(post.id, post.variant, post.url) for post in kona.extract_posts(page, 1)] == [
+        (9, 'preview', 'https://konachan.com/data/preview/9.jpg'),
+        (6, 'sample', 'https://h/sample/{}/6.jpg'.format(MD5)),
+        (3, 'preview', 'https://konachan.com/data/preview/3.jpg'),
+    ]
+
+def test_same_posts_as_beautifulsoup():
+    bs4 = pytest.importorskip('bs4')
+    page = index_page([post_item(post_id) for post_id in range(40, 0, -1)])
+    soup = bs4.BeautifulSoup(page, 'html.parser')
+    expected = []
+    for item in soup.find('ul', {'id': 'post-list-posts'}).find_all('li'):
+        rating = item.find('img', alt=True)['alt'].split()[1].lower()
+        expected.append((int(item['id'][1:]), 'https:' + item.find('a', {'class': 'directlink'})['href'], rating))
+    posts = make_konadl().extract_posts(page, 1)
+    assert [(post.id, post.url, post.rating) for post in posts] == expected
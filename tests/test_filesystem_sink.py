@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+from libkonadl import FileSystemSink, HashPrefixLayout, Post
+
+MD5 = '0123456789abcdef0123456789abcdef'
+
+
+@pytest.mark.parametrize('io_policy', FileSystemSink.IO_POLICIES)
+@pytest.mark.parametrize('size', [0, 100, 4096, 3 * 1048576 + 4096 * 3 + 17])
+def test_io_policies_write_whole_images(tmp_path, io_policy, size):
+    sink = FileSystemSink('{}/'.format(tmp_path), separate=True, layout=HashPrefixLayout(), io_policy=io_policy)
+    post = Post(1, 'https://konachan.com/image/{}/Konachan.com%20-%201%20tag.jpg'.format(MD5), 1, 'explicit')
+    content = os.urandom(size)
+
+    location = sink.write(post, content)
+    assert location == '{}/{}'.format(tmp_path, sink.key(post))
+    assert sink.key(post).startswith('explicit/') and sink.key(post).endswith('/Konachan.com_1_tag.jpg')
+    with open(location, 'rb') as image:
+        assert image.read() == content
+    assert sink.exists(post)
+    sink.remove(post)
+    assert not sink.exists(post)
+
+
+def test_remove_is_best_effort(tmp_path):
+    sink = FileSystemSink('{}/'.format(tmp_path))
+    post = Post(1, 'https://konachan.com/image/{}/Konachan.com%20-%201%20tag.jpg'.format(MD5), 1, 'safe')
+    sink.remove(post)  # Never written
+    os.mkdir(sink.path(post))
+    sink.remove(post)  # Not removable as a file
+    assert os.path.isdir(sink.path(post))
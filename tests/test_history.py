@@ -0,0 +1,24 @@
+from libkonadl import read_history, summarize_history
+from stub_site import StubSite
+
+
+def test_runs_are_recorded(make_konadl):
+    kona = make_konadl(session=StubSite(total=10), pages=2)
+    assert kona.crawl() is True
+
+    # Nothing new since the crawl
+    assert make_konadl(session=StubSite(total=10)).update() is False
+
+    # Three new posts, read ahead one page per crawler
+    assert make_konadl(session=StubSite(total=13)).update() is True
+
+    records = read_history('{}history.jsonl'.format(kona.storage))
+    assert [(record['status'], record['mode'], record['images'], record['pages']) for record in records] == [
+        ('done', 'crawl', 10, 2), ('up to date', 'update', 0, 0), ('done', 'update', 3, 2)]
+    assert records[0]['bytes'] == sum(len(StubSite().get('https://konachan.com/image/x/a%20-%20{}%20b.jpg'.format(
+        post_id)).content) for post_id in range(1, 11))
+    assert records[0]['threads'] == {'crawlers': 2, 'downloaders': 2, 'verifiers': 4}
+
+    rows = summarize_history(records)
+    assert [row['status'] for row in rows] == ['done', 'up to date', 'done']
+    assert rows[2]['median_bytes_per_second'] == rows[0]['bytes_per_second']
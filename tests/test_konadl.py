@@ -0,0 +1,33 @@
+import threading
+
+from libkonadl import MemorySink
+from stub_site import StubSite, image
+
+
+def test_iter_posts(make_konadl):
+    kona = make_konadl(session=StubSite(total=10))
+    posts = list(kona.iter_posts(pages=2))
+    assert [(post.id, post.page, post.rating) for post in posts[:4]] == [
+        (10, 1, 'questionable'), (9, 1, 'safe'), (8, 1, 'explicit'), (7, 1, 'questionable')]
+    assert [post.id for post in posts] == list(range(10, 0, -1)) and posts[-1].page == 2
+    assert kona.session.requests == {'/post': 2}
+
+    # Only wanted ratings, from every page if none is given
+    kona = make_konadl(session=StubSite(total=10), questionable=False, explicit=False)
+    assert [post.id for post in kona.iter_posts()] == [9, 6, 3]
+
+
+def test_on_downloaded(make_konadl):
+    downloaded = []
+    lock = threading.Lock()
+
+    def on_downloaded(post, location, length, elapsed):
+        assert elapsed >= 0
+        with lock:
+            downloaded.append((post.id, location, length))
+
+    kona = make_konadl(session=StubSite(total=10), pages=2, sink=MemorySink(), on_downloaded=on_downloaded)
+    assert kona.crawl() is True
+    posts = make_konadl(session=StubSite(total=10)).iter_posts(2)
+    assert sorted(downloaded) == sorted((post.id, kona.sink.key(post), len(image(post.id))) for post in posts)
+    assert sorted(kona.sink.images) == sorted(location for _, location, _ in downloaded)
@@ -0,0 +1,89 @@
+import copyreg
+import io
+import pickle
+
+from libkonadl import Post, PostQueue, Queue, pickle_queue, unpickle_queue
+
+MD5 = '0123456789abcdef0123456789abcdef'
+
+
+def make_posts():
+    return [
+        Post(1, 'https://konachan.com/image/{}/Konachan.com%20-%201%20tag.jpg'.format(MD5), 1, 'safe'),
+        Post(2, 'https://files.yande.re/jpeg/{}/yande.re%202%20tag.jpg'.format(MD5), 1, 'explicit', 'jpeg'),
+        Post(3, 'https://konachan.com/data/preview/ab/cd/abcd.jpg', 2, 'questionable', 'preview'),
+    ]
+
+
+def fields(post):
+    return post.id, post.url, post.page, post.rating, post.variant, post.attempts
+
+
+def test_save_and_load():
+    queue = PostQueue()
+    for post in make_posts():
+        queue.put(post)
+    queue.get()
+    saved = io.BytesIO()
+    queue.save(saved)
+    saved.seek(0)
+
+    loaded = PostQueue.load(saved)
+    assert loaded.qsize() == 2
+    assert [fields(loaded.get()) for _ in range(2)] == [fields(post) for post in make_posts()[1:]]
+
+
+def save_progress(storage, download_queue):
+    # Progress files as written by versions which pickled download_queue
+    copyreg.pickle(Queue, pickle_queue, unpickle_queue)
+    with open('{}download_queue.pkl'.format(storage), 'wb') as download_progress:
+        pickle.dump(download_queue, download_progress)
+    with open('{}post_queue.pkl'.format(storage), 'wb') as post_progress:
+        pickle.dump(Queue(), post_progress)
+
+
+def test_resume_pickled_tuples(make_konadl):
+    kona = make_konadl()
+    kona.save_metadata()
+    download_queue = Queue()
+    download_queue.put(('https://konachan.com/image/{}/Konachan.com%20-%20123456%20tag.jpg'.format(MD5), 3, 'safe'))
+    download_queue.put((None, None, None))
+    save_progress(kona.storage, download_queue)
+
+    assert kona.progress_files_present()
+    kona.read_queues()
+    assert kona.download_queue.qsize() == 1
+    post = kona.download_queue.get()
+    assert (post.id, post.page, post.rating, post.variant, post.md5) == (123456, 3, 'safe', 'original', MD5)
+
+
+def test_resume_pickled_posts(tmp_path, make_konadl):
+    kona = make_konadl()
+    kona.save_metadata()
+    old_post = Post(7, 'https://konachan.com/image/{}/Konachan.com%20-%207%20tag.jpg'.format(MD5), 2, 'explicit')
+    # Posts pickled before variants and attempts existed
+    del old_post.variant
+    del old_post.attempts
+    download_queue = Queue()
+    download_queue.put(old_post)
+    save_progress(kona.storage, download_queue)
+
+    kona.read_queues()
+    assert fields(kona.download_queue.get()) == (7, old_post.url, 2, 'explicit', 'original', 0)
+
+    # Progress is saved in the new format from now on
+    kona.save_queues()
+    assert sorted(path.name for path in tmp_path.iterdir() if 'queue' in path.name) == [
+        'download_queue.bin', 'post_queue.pkl']
+
+
+def test_attempts_are_saved():
+    queue = PostQueue()
+    for number, post in enumerate(make_posts()):
+        post.attempts = number + 1
+        queue.put(post)
+    saved = io.BytesIO()
+    queue.save(saved)
+    saved.seek(0)
+    loaded = PostQueue.load(saved)
+    assert [loaded.get().attempts for _ in range(3)] == [1, 2, 3]
@@ -0,0 +1,89 @@
+import os
+import queue
+import threading
+
+import pytest
+import requests
+
+from libkonadl import MemorySink, Queue, QueueClosed
+from stub_site import StubSite
+
+
+def test_nonblocking_get_and_put():
+    jobs = Queue(maxsize=1)
+    with pytest.raises(queue.Empty):
+        jobs.get_nowait()
+    jobs.put_nowait(1)
+    with pytest.raises(queue.Full):
+        jobs.put_nowait(2)
+    with pytest.raises(queue.Full):
+        jobs.put(2, timeout=0.01)
+    assert jobs.get_nowait() == 1
+    with pytest.raises(queue.Empty):
+        jobs.get(timeout=0.01)
+
+
+def test_closed_queue():
+    jobs = Queue(maxsize=1)
+    jobs.put(1)
+    jobs.close()
+    with pytest.raises(QueueClosed):
+        jobs.put(2)
+    assert jobs.get() == 1  # Jobs left are still handed out
+    with pytest.raises(QueueClosed):
+        jobs.get()
+    with pytest.raises(QueueClosed):
+        jobs.get_nowait()
+
+
+def test_close_wakes_up_waiting_threads():
+    jobs = Queue()
+    errors = []
+
+    def worker():
+        try:
+            jobs.get()
+        except QueueClosed as error:
+            errors.append(error)
+    thread = threading.Thread(target=worker)
+    thread.start()
+    jobs.close()
+    thread.join(5)
+    assert not thread.is_alive() and len(errors) == 1
+
+
+def test_cancel_from_another_thread(make_konadl):
+    kona = make_konadl(session=StubSite(delay=0.01), pages=5)
+
+    results = []
+    crawl = threading.Thread(target=lambda: results.append(kona.crawl()))
+    timer = threading.Timer(0.05, kona.cancel)
+    crawl.start()
+    timer.start()
+    crawl.join(10)
+    assert not crawl.is_alive(), 'crawl did not return after cancel()'
+    assert results == [False]
+    assert os.path.isfile('{}download_queue.bin'.format(kona.storage))
+
+
+class UnreachableSink(MemorySink):
+    # Fails like S3Sink does when its endpoint is down
+
+    def write(self, post, content):
+        raise requests.ConnectionError('endpoint is down')
+
+    def remove(self, post):
+        raise requests.ConnectionError('endpoint is down')
+
+
+def test_failing_sink_does_not_hang(make_konadl):
+    kona = make_konadl(session=StubSite(total=3), pages=1, sink=UnreachableSink(), max_attempts=2)
+    kona.downloader_threads_amount = 1
+    results = []
+    crawl = threading.Thread(target=lambda: results.append(kona.crawl()))
+    crawl.start()
+    crawl.join(10)
+    assert not crawl.is_alive(), 'crawl hung on a failing sink'
+    assert results == [True]
+    with open('{}dead_letter.jsonl'.format(kona.storage)) as dead_letterf:
+        assert len(dead_letterf.readlines()) == 3
@@ -0,0 +1,58 @@
+import os
+import time
+
+import pytest
+import requests
+
+from libkonadl import NullSink, RecordingSession, ReplaySession, read_history
+from stub_site import StubSite, image
+
+
+def record(tmp_path, make_konadl, record_images):
+    kona = make_konadl('recorded', pages=2)
+    kona.session = RecordingSession(StubSite(total=10), '{}/recording'.format(tmp_path), record_images)
+    assert kona.crawl() is True
+    return kona
+
+
+@pytest.mark.parametrize('record_images', [False, True])
+def test_replay_leaves_storage_alone(tmp_path, make_konadl, record_images):
+    recorded = record(tmp_path, make_konadl, record_images)
+
+    # Replayed into a storage that already has the images
+    kona = make_konadl('replayed', pages=2, replay='{}/recording'.format(tmp_path), replay_latency=0)
+    for name in os.listdir(recorded.storage):
+        if name.endswith('.jpg') or name == 'checksums.md5':
+            os.link(recorded.storage + name, kona.storage + name)
+    before = sorted(os.listdir(kona.storage))
+    assert kona.crawl() is True
+
+    assert isinstance(kona.sink, NullSink)
+    assert kona.total_downloads == 10
+    assert kona.verify is record_images
+    assert [name for name in sorted(os.listdir(kona.storage)) if name.endswith(('.jpg', '.md5'))] == [
+        name for name in before if name.endswith(('.jpg', '.md5'))]
+    with open('{}checksums.md5'.format(kona.storage)) as checksums:
+        assert len(checksums.readlines()) == 10
+
+
+def test_replay_missing_page(tmp_path, make_konadl):
+    record(tmp_path, make_konadl, False)
+    kona = make_konadl('replayed', session=ReplaySession('{}/recording'.format(tmp_path), 0), yandere=True)
+    with pytest.raises(requests.HTTPError) as error:
+        list(kona.iter_posts(pages=1))
+    assert error.value.response.status_code == 404
+
+
+def test_recorded_time_leaves_out_the_consumer(tmp_path):
+    recorder = RecordingSession(StubSite(delay=0.05), str(tmp_path))
+    response = recorder.get('https://konachan.com/image/x/Konachan.com%20-%2010%20tag.jpg', stream=True)
+    body = b''
+    for chunk in response.iter_content(40):
+        time.sleep(0.1)  # As if throttled
+        body += chunk
+    assert body == image(10)
+
+    recorded, = read_history('{}/responses.jsonl'.format(tmp_path))
+    assert 0.05 <= recorded['elapsed'] < 0.1
+    assert recorded['length'] == len(body)
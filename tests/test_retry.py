@@ -0,0 +1,126 @@
+import threading
+import time
+import urllib.parse
+
+import requests
+
+from libkonadl import MAX_RETRY_BACKOFF
+from stub_site import StubResponse, StubSite
+
+
+class FlakySite(StubSite):
+    """ StubSite answering some requests with errors first
+
+    images and pages map post ids and page numbers to the
+    status codes returned, one per request, before the
+    request succeeds.
+    """
+
+    def __init__(self, images=None, pages=None, **kwargs):
+        StubSite.__init__(self, **kwargs)
+        self.images = images or {}
+        self.pages = pages or {}
+
+    def get(self, url, params=None, **kwargs):
+        path = urllib.parse.urlparse(url).path
+        if path.startswith('/image/'):
+            statuses = self.images.get(int(urllib.parse.unquote(path).split(' ')[2]))
+        elif path == '/post':
+            statuses = self.pages.get(int(urllib.parse.parse_qs(urllib.parse.urlparse(url).query)['page'][0]))
+        else:
+            statuses = None
+        if statuses:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            return StubResponse(statuses.pop(0), b'')
+        return StubSite.get(self, url, params, **kwargs)
+
+
+def crawl(make_konadl, site, **attributes):
+    # Crawls the first page of site, returning the Konadl object
+    # and the ids of the posts downloaded
+    downloaded = set()
+    kona = make_konadl(session=site, pages=1, **attributes)
+    kona.on_downloaded = lambda post, *args: downloaded.add(post.id)
+    assert kona.crawl() is True
+    return kona, downloaded
+
+
+def dead_letters(kona):
+    return sorted((job.get('id'), job.get('page'), job['attempts']) for job in kona.read_dead_letter())
+
+
+def http_error(status_code, headers=None):
+    return requests.HTTPError('HTTP Error {}'.format(status_code),
+                              response=StubResponse(status_code, b'', headers if headers is not None else {}))
+
+
+def test_backoff_doubles_with_attempts(make_konadl):
+    kona = make_konadl(retry_backoff=0.5)
+    error = http_error(503)
+    assert [kona.retry_delay(attempts, error) for attempts in (1, 2, 3, 4)] == [0.5, 1, 2, 4]
+    assert kona.retry_delay(1, ValueError('not an HTTP error')) == 0.5
+    assert kona.retry_delay(30, error) == MAX_RETRY_BACKOFF
+
+
+def test_rate_limited_backoff(make_konadl):
+    kona = make_konadl(retry_backoff=0.5, rate_limit_backoff=20)
+    assert kona.retry_delay(0, http_error(429)) == 20
+    assert kona.retry_delay(3, http_error(429, {'retry-after': '7'})) == 7
+    # An HTTP date is not worth parsing, the default is used instead
+    assert kona.retry_delay(0, http_error(429, {'retry-after': 'Wed, 21 Oct 2026 07:28:00 GMT'})) == 20
+
+
+def test_backoff_is_cut_short_by_cancel(make_konadl):
+    kona = make_konadl(retry_backoff=60)
+    threading.Timer(0.05, kona.cancel).start()
+    begin_time = time.time()
+    kona.back_off(1, http_error(503))
+    assert time.time() - begin_time < 5
+
+
+def test_permanent_errors_go_to_dead_letter(make_konadl):
+    site = FlakySite(total=5, images={5: [404], 4: [410], 3: [500]})
+    kona, downloaded = crawl(make_konadl, site)
+    assert downloaded == {1, 2, 3}
+    assert dead_letters(kona) == [(4, 1, 1), (5, 1, 1)]
+    assert {job['id']: job['error'] for job in kona.read_dead_letter()} == {
+        4: 'HTTPError: HTTP Error 410', 5: 'HTTPError: HTTP Error 404'}
+    assert kona.stats.counters['retries'] == 1
+
+
+def test_max_attempts(make_konadl):
+    site = FlakySite(total=5, images={5: [503] * 3, 4: [503] * 2})
+    kona, downloaded = crawl(make_konadl, site, max_attempts=3)
+    assert downloaded == {1, 2, 3, 4}
+    assert dead_letters(kona) == [(5, 1, 3)]
+    assert site.images[5] == []
+
+
+def test_rate_limiting_is_not_an_attempt(make_konadl):
+    site = FlakySite(total=5, images={5: [429] * 4}, pages={1: [429] * 2})
+    kona, downloaded = crawl(make_konadl, site, max_attempts=2)
+    assert downloaded == {1, 2, 3, 4, 5}
+    assert kona.read_dead_letter() == []
+    assert kona.stats.counters['http_429'] == 6
+
+
+def test_failed_page_goes_to_dead_letter(make_konadl):
+    site = FlakySite(total=5, pages={1: [503] * 2})
+    kona, downloaded = crawl(make_konadl, site, max_attempts=2)
+    assert downloaded == set()
+    assert dead_letters(kona) == [(None, 1, 2)]
+
+
+def test_retry_dead_letter(make_konadl):
+    site = FlakySite(total=5, images={5: [503] * 2, 4: [404]})
+    kona, downloaded = crawl(make_konadl, site, max_attempts=2)
+    assert dead_letters(kona) == [(4, 1, 1), (5, 1, 2)]
+
+    # The jobs run again with fresh attempt counters
+    site.images[5] = [503]
+    kona = make_konadl(session=site, max_attempts=2)
+    kona.on_downloaded = lambda post, *args: downloaded.add(post.id)
+    assert kona.retry_dead_letter() is True
+    assert downloaded == {1, 2, 3, 4, 5}
+    assert kona.read_dead_letter() == []
+    assert kona.retry_dead_letter() is False
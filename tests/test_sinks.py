@@ -0,0 +1,86 @@
+import pytest
+
+from libkonadl import BucketSink, HashPrefixLayout, MemorySink, ObjectStoreSink, Post, Sink
+
+MD5 = '0123456789abcdef0123456789abcdef'
+
+
+def make_post(variant='original'):
+    return Post(5, 'https://konachan.com/image/{}/Konachan.com%20-%205%20tag.jpg'.format(MD5), 1, 'safe', variant)
+
+
+class MissingError(Exception):
+    # Raised like botocore's ClientError for missing objects
+
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.response = {'Error': {'Code': code}}
+
+
+class StubClient:
+    # Keeps objects in a dict like a boto3 S3 client would in a bucket
+
+    def __init__(self):
+        self.objects = {}
+        self.head_error = None
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Bucket, Key] = Body
+
+    def head_object(self, Bucket, Key):
+        if self.head_error is not None:
+            raise self.head_error
+        if (Bucket, Key) not in self.objects:
+            raise MissingError('404')
+        return {'ContentLength': len(self.objects[Bucket, Key])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+
+def test_sinks_are_abstract():
+    with pytest.raises(TypeError):
+        Sink()
+    with pytest.raises(TypeError):
+        BucketSink('bucket')
+
+
+def test_memory_sink():
+    sink = MemorySink(separate=True)
+    post = make_post()
+    assert not sink.exists(post)
+    assert sink.write(post, bytearray(b'image')) == 'safe/Konachan.com_5_tag.jpg'
+    assert sink.exists(post)
+    assert sink.images == {'safe/Konachan.com_5_tag.jpg': b'image'}
+
+    # Variants are kept apart from the original
+    assert not sink.exists(make_post('jpeg'))
+    sink.remove(post)
+    sink.remove(post)
+    assert not sink.exists(post) and sink.images == {}
+
+
+def test_object_store_sink():
+    client = StubClient()
+    sink = ObjectStoreSink(client, 'bucket', 'konachan/', layout=HashPrefixLayout())
+    post = make_post()
+    key = sink.write(post, b'image')
+    assert key.startswith('konachan/') and key.endswith('/Konachan.com_5_tag.jpg')
+    assert client.objects == {('bucket', key): b'image'}
+    assert sink.exists(post)
+
+    sink.remove(post)
+    assert not sink.exists(post)
+    client.head_error = MissingError('NoSuchKey')
+    assert not sink.exists(post)
+
+
+def test_object_store_errors_are_raised():
+    client = StubClient()
+    sink = ObjectStoreSink(client, 'bucket')
+    client.head_error = MissingError('403')
+    with pytest.raises(MissingError):
+        sink.exists(make_post())
+    client.head_error = ConnectionError('endpoint is down')
+    with pytest.raises(ConnectionError):
+        sink.exists(make_post())
@@ -0,0 +1,43 @@
+import hashlib
+
+from libkonadl import FileSystemSink, PostQueue
+from stub_site import StubSite, image
+
+
+def image_requests(site):
+    # Ids of the posts whose images have been requested
+    return sorted(int(path.split('%20')[2]) for path in site.requests if path.startswith('/image/'))
+
+
+def store_images(kona):
+    # Post 5 is in the sink, post 4 only in checksums.md5
+    posts = {post.id: post for post in kona.iter_posts(1)}
+    FileSystemSink(kona.storage).write(posts[5], image(5))
+    with open('{}checksums.md5'.format(kona.storage), 'w') as checksums:
+        checksums.write('{}  elsewhere/4.jpg\n'.format(hashlib.md5(image(4)).hexdigest()))
+
+
+def test_stored_images_never_enter_download_queue(make_konadl, monkeypatch):
+    queued = []
+    put = PostQueue.put
+
+    def record_put(queue, post, *args, **kwargs):
+        queued.append(post.id)
+        return put(queue, post, *args, **kwargs)
+
+    monkeypatch.setattr(PostQueue, 'put', record_put)
+    kona = make_konadl(session=StubSite(total=5), pages=1)
+    store_images(kona)
+    assert kona.crawl() is True
+    assert sorted(queued) == [1, 2, 3]
+    assert image_requests(kona.session) == [1, 2, 3]
+    assert kona.total_downloads == 3
+
+
+def test_skip_existing_off(make_konadl):
+    kona = make_konadl(session=StubSite(total=5), pages=1)
+    store_images(kona)
+    kona.skip_existing = False
+    assert kona.crawl() is True
+    assert image_requests(kona.session) == [1, 2, 3, 4, 5]
+
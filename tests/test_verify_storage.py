@@ -0,0 +1,27 @@
+import hashlib
+import os
+
+JPEG = b'\xff\xd8\xff\xe0image\xff\xd9'
+
+
+def make_storage(tmp_path, make_konadl):
+    kona = make_konadl(verifier_threads_amount=2)
+    (tmp_path / 'good.jpg').write_bytes(JPEG)
+    (tmp_path / 'truncated.jpg').write_bytes(JPEG[:-2])
+    (tmp_path / 'corrupt.jpg').write_bytes(JPEG.replace(b'image', b'imagf'))
+    (tmp_path / 'checksums.md5').write_text('{0}  good.jpg\n{0}  corrupt.jpg\n'.format(hashlib.md5(JPEG).hexdigest()))
+    return kona
+
+
+def test_verify_storage(tmp_path, make_konadl):
+    kona = make_storage(tmp_path, make_konadl)
+    assert kona.verify_storage() == [kona.storage + 'corrupt.jpg', kona.storage + 'truncated.jpg']
+
+
+def test_unreadable_images_fail(tmp_path, make_konadl):
+    kona = make_storage(tmp_path, make_konadl)
+    os.symlink(str(tmp_path / 'vanished.jpg'), str(tmp_path / 'dangling.jpg'))
+    for number in range(20):
+        (tmp_path / 'image{}.jpg'.format(number)).write_bytes(JPEG)
+    failed = kona.verify_storage()
+    assert failed == [kona.storage + name for name in ('corrupt.jpg', 'dangling.jpg', 'truncated.jpg')]